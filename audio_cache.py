@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Play counts are only kept for this many recently seen tracks
+MAX_TRACKED_PLAYS = 10000
+
+def cache_file_name(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest() + '.opus'
+
+class AudioCache:
+    """Disk cache of Ogg/Opus files for tracks that keep getting played.
+
+    Once a track has been played min_plays times, ffmpeg fetches it once in the
+    background and stores it as Ogg/Opus, copying Opus streams as-is and encoding
+    anything else. Files are written under a temporary name and renamed into place,
+    so a reader (or another cluster sharing the directory) never sees a partial
+    file, and each track is fetched by at most one task per process. The least
+    recently played files are evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: str, *, max_bytes: int, min_plays: int = 3, max_duration: float = 1800,
+                 max_populating: int = 2, bitrate: str = '128k', before_options: str = ''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.bitrate = bitrate
+        self.before_options = before_options.split()
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # file name -> size, least recently played first
+        self.total_bytes = 0
+        self.plays: "OrderedDict[str, int]" = OrderedDict()
+        self.populating: Dict[str, asyncio.Task] = {}
+        self.max_populating = max_populating
+        # Made on first use: the cache is built at import, and before Python 3.10 a
+        # semaphore binds to the event loop current when it's created
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'failed': 0, 'evictions': 0}
+        self._scan()
+
+    def _scan(self):
+        """Index files left by earlier runs, least recently played first"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.opus'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+            elif '.tmp' in entry.name and time.time() - entry.stat().st_mtime > 600:
+                # Interrupted download; recent ones may belong to another process still writing
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Path of the cached file for a track, or None"""
+        name = cache_file_name(key)
+        path = os.path.join(self.directory, name)
+        try:
+            # Bumping the mtime keeps the LRU order across restarts
+            os.utime(path)
+        except OSError:
+            if name in self.entries:
+                # Evicted by another process sharing the directory
+                self.total_bytes -= self.entries.pop(name)
+            self.stats['misses'] += 1
+            return None
+        if name not in self.entries:
+            # Stored by another process sharing the directory
+            size = os.path.getsize(path)
+            self.entries[name] = size
+            self.total_bytes += size
+        self.entries.move_to_end(name)
+        self.stats['hits'] += 1
+        return path
+
+    def record_play(self, key: str, stream_url: str, *, duration: float = 0, opus: bool = False):
+        """Count a play and start caching the track once it has become popular"""
+        count = self.plays.pop(key, 0) + 1
+        self.plays[key] = count
+        while len(self.plays) > MAX_TRACKED_PLAYS:
+            self.plays.popitem(last=False)
+        # Live streams report no duration; very long tracks aren't worth the disk
+        if count < self.min_plays or not duration or duration > self.max_duration or not stream_url:
+            return
+        name = cache_file_name(key)
+        if name in self.entries or key in self.populating:
+            return
+        task = asyncio.create_task(self._populate(key, name, stream_url, opus))
+        self.populating[key] = task
+        task.add_done_callback(lambda t: self.populating.pop(key, None))
+
+    async def _populate(self, key: str, name: str, stream_url: str, opus: bool):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_populating)
+        async with self.slots:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                return
+            temp = f"{path}.tmp{os.getpid()}"
+            codec = ['-c:a', 'copy'] if opus else ['-c:a', 'libopus', '-b:a', self.bitrate]
+            process = None
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', *self.before_options, '-i', stream_url,
+                    '-vn', '-map_metadata', '-1', *codec, '-f', 'ogg', temp,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await process.communicate()
+                if process.returncode != 0:
+                    raise RuntimeError(stderr.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+                os.replace(temp, path)
+            except asyncio.CancelledError:
+                if process is not None and process.returncode is None:
+                    process.kill()
+                self._discard(temp)
+                raise
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.warning(f"Failed to cache audio for {key}: {e}")
+                self._discard(temp)
+                return
+            size = os.path.getsize(path)
+            self.entries[name] = size
+            self.total_bytes += size
+            self.stats['stored'] += 1
+            logger.info(f"Cached audio for {key} ({size / 2 ** 20:.1f} MB, {self.total_bytes / 2 ** 20:.0f} MB total)")
+            self._evict()
+
+    def _discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self._discard(os.path.join(self.directory, name))
+            self.stats['evictions'] += 1
+
+    def hit_ratio(self) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+    def close(self):
+        for task in list(self.populating.values()):
+            task.cancel()
@@ -0,0 +1,137 @@
+"""Compare CPU cost per concurrent stream between the PCM and Opus playback modes.
+
+Generates a local Opus/WebM fixture with ffmpeg, serves it over loopback HTTP (the
+bot's ffmpeg options are meant for network streams), then plays it through N concurrent
+sources per mode, reading 20 ms frames exactly like discord.py's audio player does.
+In PCM mode each frame is also Opus-encoded (when libopus is available), since that
+is what the voice client would do before sending it.
+
+Usage:
+    python benchmarks/bench_playback_modes.py --streams 8 --seconds 30
+"""
+import argparse
+import functools
+import http.server
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+
+import sandbox  # noqa: F401  (must come before the bot)
+
+from discord import opus  # noqa: E402
+
+import bot  # noqa: E402
+
+FRAME_SECONDS = 0.02
+
+def make_fixture(path, seconds):
+    """Render a stereo Opus/WebM file, the format YouTube usually serves"""
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=660:duration={seconds}",
+            "-filter_complex", "[0:a][1:a]amerge=inputs=2[a]", "-map", "[a]",
+            "-c:a", "libopus", "-b:a", "128k", path,
+        ],
+        check=True,
+    )
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve_fixture(path):
+    """Serve a fixture file on a loopback port; returns its URL and the server"""
+    handler = functools.partial(_QuietHandler, directory=os.path.dirname(path))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/{os.path.basename(path)}", server
+
+def load_opus():
+    if opus.is_loaded():
+        return True
+    try:
+        opus._load_default()
+    except Exception:
+        pass
+    return opus.is_loaded()
+
+def play_stream(source, frames, encode, realtime):
+    encoder = opus.Encoder() if encode else None
+    start = time.perf_counter()
+    for i in range(frames):
+        data = source.read()
+        if not data:
+            break
+        if encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        if realtime:
+            delay = start + (i + 1) * FRAME_SECONDS - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    source.cleanup()
+
+def run_mode(mode, fixture, streams, seconds, realtime):
+    data = {"title": "fixture", "url": fixture, "acodec": "opus", "duration": seconds}
+    encode = mode == "pcm" and load_opus()
+    frames = int(seconds / FRAME_SECONDS)
+
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+
+    # ffmpeg spawn cost is included, as it is for every song the bot plays
+    sources = [bot.YTDLSource.create(fixture, data=data, mode=mode) for _ in range(streams)]
+    threads = [threading.Thread(target=play_stream, args=(s, frames, encode, realtime)) for s in sources]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    wall = time.perf_counter() - wall_before
+    python_cpu = time.process_time() - cpu_before
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ffmpeg_cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+    total = python_cpu + ffmpeg_cpu
+    audio_seconds = streams * seconds
+    return {
+        "mode": mode,
+        "encode": encode,
+        "wall": wall,
+        "python_cpu": python_cpu,
+        "ffmpeg_cpu": ffmpeg_cpu,
+        "cpu_per_stream": total / streams,
+        # CPU seconds per second of audio; 1 / this is how many streams one core sustains
+        "load_per_stream": total / audio_seconds,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=8, help="concurrent streams per mode")
+    parser.add_argument("--seconds", type=int, default=30, help="audio length per stream")
+    parser.add_argument("--realtime", action="store_true", help="pace reads at 20 ms like a real voice client")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, "fixture.webm")
+        make_fixture(fixture, args.seconds)
+        url, server = serve_fixture(fixture)
+
+        print(f"{args.streams} streams x {args.seconds}s of Opus/WebM audio")
+        print(f"{'mode':<6} {'wall s':>8} {'python s':>9} {'ffmpeg s':>9} {'cpu/stream':>11} {'streams/core':>13}")
+        for mode in bot.PLAYBACK_MODES:
+            r = run_mode(mode, url, args.streams, args.seconds, args.realtime)
+            note = "" if mode != "pcm" or r["encode"] else "  (libopus not loaded, encode cost excluded)"
+            print(
+                f"{r['mode']:<6} {r['wall']:>8.2f} {r['python_cpu']:>9.2f} {r['ffmpeg_cpu']:>9.2f} "
+                f"{r['cpu_per_stream']:>11.3f} {1 / r['load_per_stream']:>13.1f}{note}"
+            )
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Micro-benchmarks for MusicQueue operations on long queues.
+
+Compares MusicQueue with the plain list-based queue it replaced, for the
+operations the bot performs: advancing, /remove by position, shuffled advances and
+rendering a /queue page.
+
+Usage:
+    python benchmarks/bench_queue.py --size 10000
+"""
+import argparse
+import random
+import timeit
+
+import sandbox  # noqa: F401  (must come before the bot)
+
+import bot  # noqa: E402
+
+class ListQueue:
+    """The previous list-based implementation, for reference"""
+
+    def __init__(self):
+        self.queue = []
+
+    def add(self, item):
+        self.queue.append(item)
+
+    def remove(self, index):
+        return self.queue.pop(index)
+
+    def get_next(self):
+        return self.queue.pop(0)
+
+    def get_next_shuffled(self):
+        # What a naive shuffle over a list costs: copy and reshuffle on every advance
+        order = self.queue[:]
+        random.shuffle(order)
+        self.queue.remove(order[0])
+        return order[0]
+
+    def page(self, number, size=bot.QUEUE_PAGE_SIZE):
+        return self.queue[(number - 1) * size:number * size]
+
+def make_tracks(size):
+    return [bot.Track(f"Song {i}", duration=200, webpage_url=f"https://www.youtube.com/watch?v={i:011d}") for i in range(size)]
+
+def filled(cls, tracks):
+    queue = cls()
+    for track in tracks:
+        queue.add(track)
+    return queue
+
+def bench(label, setup, op, repeat, number):
+    """Best-of-repeat time per op, rebuilding the queue before each run"""
+    times = []
+    for _ in range(repeat):
+        queue = setup()
+        times.append(timeit.timeit(lambda: op(queue), number=number) / number)
+    print(f"  {label:<28} {min(times) * 1e6:>10.2f} us/op")
+
+def shuffled_next(queue):
+    queue.shuffle = True
+    return queue.get_next()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=10000, help="entries per queue")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tracks = make_tracks(args.size)
+    # Each run consumes entries, so keep the op count well below the queue size
+    number = max(1, min(1000, args.size // 10))
+    middle = args.size // 2
+    last_page = -(-args.size // bot.QUEUE_PAGE_SIZE)
+
+    for name, cls in (("MusicQueue", bot.MusicQueue), ("list baseline", ListQueue)):
+        print(f"{name}, {args.size} entries:")
+        setup = lambda cls=cls: filled(cls, tracks)
+        bench("add", cls, lambda q: q.add(tracks[0]), args.repeat, number)
+        bench("next track", setup, lambda q: q.get_next(), args.repeat, number)
+        bench("remove middle", setup, lambda q: q.remove(middle - number), args.repeat, number)
+        if cls is bot.MusicQueue:
+            bench("shuffled next track", setup, shuffled_next, args.repeat, number)
+        else:
+            bench("shuffled next track", setup, lambda q: q.get_next_shuffled(), args.repeat, min(number, 50))
+        bench("render middle page", setup, lambda q: q.page(last_page // 2), args.repeat, number)
+        bench("render last page", setup, lambda q: q.page(last_page), args.repeat, number)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Offline load test: drive the Music cog across many fake guilds with no network.
+
+Each fake guild gets a simulated /play burst through the real command callbacks. A
+fake YoutubeDL with configurable latency answers lookups and points every stream at
+an ffmpeg-generated fixture served over loopback HTTP, and a stub VoiceClient pulls 20 ms frames on its
+own thread the way discord.py's audio player does (Opus-encoding PCM frames when
+libopus is available).
+
+Reports /play response latency percentiles, CPU per stream, memory per guild and,
+with --ramp, the largest guild count that still plays without late frames.
+
+Usage:
+    python benchmarks/loadtest.py --guilds 100 --seconds 20
+    python benchmarks/loadtest.py --ramp --guilds 400 --seconds 10 --mode opus
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+import sandbox  # noqa: F401  (must come before the bot)
+
+import discord  # noqa: E402
+
+import bot  # noqa: E402
+from bench_playback_modes import FRAME_SECONDS, load_opus, make_fixture, serve_fixture  # noqa: E402
+from extraction import ExtractionPool  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL; every lookup resolves to the local fixture"""
+    latency = 0.3
+    fixture = ""
+    duration = 60
+
+    def __init__(self, options):
+        self.options = options
+
+    def extract_info(self, url, download=False, process=True):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        video_id = f"{abs(hash(url)) % 10 ** 11:011d}"
+        return {
+            'id': video_id,
+            'title': f"Fixture {url}",
+            'duration': self.duration,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'url': self.fixture,
+            'acodec': 'opus',
+            'ext': 'webm',
+            'extractor': 'youtube',
+            'uploader': 'loadtest',
+        }
+
+    @staticmethod
+    def sanitize_info(info):
+        return info
+
+class FakeVoiceClient(discord.VoiceClient):
+    """Consumes frames at real-time rate on a thread and counts late frames"""
+
+    def __init__(self, channel, encode):
+        self.channel = channel
+        self.encode = encode
+        self.encoder = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.connected = True
+        self.frames = 0
+        self.late_frames = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.thread is not None and not self.stopped.is_set() and self.resumed.is_set()
+
+    def is_paused(self):
+        return self.thread is not None and not self.stopped.is_set() and not self.resumed.is_set()
+
+    def play(self, source, *, after=None, **kwargs):
+        if self.is_playing() or self.is_paused():
+            raise discord.ClientException("Already playing audio.")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(source, after, self.stopped), daemon=True)
+        self.thread.start()
+
+    def _run(self, source, after, stopped):
+        encoder = (self.encoder or discord.opus.Encoder()) if self.encode and not source.is_opus() else None
+        start = time.perf_counter()
+        loops = 0
+        error = None
+        try:
+            while not stopped.is_set():
+                if not self.resumed.is_set():
+                    self.resumed.wait()
+                    start = time.perf_counter()
+                    loops = 0
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                if encoder is not None:
+                    encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                loops += 1
+                self.frames += 1
+                delay = start + loops * FRAME_SECONDS - time.perf_counter()
+                if delay < -FRAME_SECONDS:
+                    self.late_frames += 1
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            # Like discord.py's AudioPlayer, count as stopped before after() runs
+            stopped.set()
+            source.cleanup()
+        if after is not None:
+            after(error)
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.resumed.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+class FakeChannel:
+    def __init__(self, guild, encode):
+        self.guild = guild
+        self.id = guild.id
+        self.encode = encode
+        self.members = []
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self, self.encode)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id, encode):
+        self.id = guild_id
+        self.shard_id = 0
+        self.voice_client = None
+        self.channel = FakeChannel(self, encode)
+
+    def get_channel(self, channel_id):
+        return self.channel if channel_id == self.channel.id else None
+
+class FakeMember(discord.Member):
+    def __init__(self, guild):
+        self._guild = guild
+
+    @property
+    def id(self):
+        return self._guild.id
+
+    @property
+    def bot(self):
+        return False
+
+    @property
+    def display_name(self):
+        return f"listener-{self._guild.id}"
+
+    @property
+    def display_avatar(self):
+        return type("Avatar", (), {"url": "https://cdn.discordapp.com/embed/avatars/0.png"})()
+
+    @property
+    def voice(self):
+        return type("VoiceState", (), {"channel": self._guild.channel})()
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, *args, **kwargs):
+        if self.interaction.answered_at is None:
+            self.interaction.answered_at = time.perf_counter()
+
+class FakeInteraction:
+    def __init__(self, guild):
+        self.guild = guild
+        self.user = FakeMember(guild)
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(self)
+        self.extras = {}
+        self.command = None
+        self.answered_at = None
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = None
+        self.guilds = []
+
+    @property
+    def voice_clients(self):
+        return [g.voice_client for g in self.guilds if g.voice_client is not None]
+
+    def get_guild(self, guild_id):
+        return None
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+def rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+def ffmpeg_pids():
+    return [s._process.pid for s in list(bot.ffmpeg_sources) if getattr(s, "_process", None) and s._process.poll() is None]
+
+async def run_step(guilds_count, args, encode):
+    """Start playback in guilds_count fake guilds and measure one steady-state window"""
+    loop = asyncio.get_running_loop()
+    fake_bot = FakeBot(loop)
+    music = bot.Music(fake_bot)
+    music.quotas = bot.Quotas()  # Measure capacity, not the admission limits
+    default_mode = bot.PLAYBACK_MODE
+    bot.PLAYBACK_MODE = args.mode
+    guilds = [FakeGuild(10_000 + i, encode) for i in range(guilds_count)]
+    fake_bot.guilds = guilds
+
+    rss_before = rss_bytes()
+    interactions = []
+
+    async def play(guild, n):
+        interaction = FakeInteraction(guild)
+        interactions.append((time.perf_counter(), interaction))
+        query = f"loadtest track {random.randrange(args.tracks)}" if n else f"loadtest track {guild.id % args.tracks}"
+        await music.play.callback(music, interaction, query)
+
+    await asyncio.gather(*(play(g, n) for g in guilds for n in range(1 + args.queued)))
+    latencies = [i.answered_at - started for started, i in interactions if i.answered_at is not None]
+    rss_guilds = rss_bytes() - rss_before
+
+    await asyncio.sleep(1.0)  # Let ffmpeg settle before measuring
+    for g in guilds:
+        if g.voice_client:
+            g.voice_client.frames = g.voice_client.late_frames = 0
+    pids = ffmpeg_pids()
+    ffmpeg_cpu_before = {pid: cpu_seconds(pid) for pid in pids}
+    cpu_before = time.process_time()
+    await asyncio.sleep(args.seconds)
+    python_cpu = time.process_time() - cpu_before
+    ffmpeg_cpu = sum(cpu_seconds(pid) - before for pid, before in ffmpeg_cpu_before.items())
+    ffmpeg_rss = sum(rss_bytes(pid) for pid in pids)
+
+    voice_clients = [g.voice_client for g in guilds if g.voice_client]
+    frames = sum(vc.frames for vc in voice_clients)
+    late = sum(vc.late_frames for vc in voice_clients)
+    streams = sum(1 for vc in voice_clients if vc.is_playing())
+
+    for g in guilds:
+        music.reset_guild(g.id)
+        if g.voice_client:
+            await g.voice_client.disconnect()
+    await asyncio.sleep(0.5)
+    music.idle_tracker.cancel_all()
+    bot.PLAYBACK_MODE = default_mode
+
+    return {
+        "guilds": guilds_count,
+        "streams": streams,
+        "answered": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "cpu_per_stream": (python_cpu + ffmpeg_cpu) / max(1, streams) / args.seconds,
+        "python_cpu": python_cpu / args.seconds,
+        "ffmpeg_cpu": ffmpeg_cpu / args.seconds,
+        "memory_per_guild": (rss_guilds + ffmpeg_rss) / guilds_count,
+        "late_ratio": late / frames if frames else 1.0,
+    }
+
+def report(r):
+    print(
+        f"{r['guilds']:>6} {r['streams']:>7} {r['p50'] * 1000:>8.0f} {r['p95'] * 1000:>8.0f} {r['p99'] * 1000:>8.0f} "
+        f"{r['cpu_per_stream'] * 100:>10.2f}% {r['memory_per_guild'] / 2 ** 20:>10.1f} {r['late_ratio'] * 100:>7.2f}%"
+    )
+
+async def run(args):
+    encode = args.mode == "pcm" and load_opus()
+    if args.mode == "pcm" and not encode:
+        print("libopus not loaded; PCM frames are not encoded, so pcm CPU is understated")
+
+    # Swap in an extraction pool backed by the fake extractor and a throwaway metadata cache
+    bot.extraction_pool.shutdown()
+    bot.extraction_pool = ExtractionPool(
+        bot.ytdl_format_options,
+        workers=args.workers,
+        max_pending=args.max_pending,
+        ytdl_class=FakeYoutubeDL,
+    )
+    bot.metadata_cache.close()
+    bot.metadata_cache = MetadataCache(os.path.join(sandbox.tmp.name, "metadata.sqlite3"))
+
+    print(f"{args.mode} mode, extractor latency {FakeYoutubeDL.latency * 1000:.0f}ms, {args.workers} extraction workers")
+    print(f"{'guilds':>6} {'streams':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'cpu/stream':>11} {'MB/guild':>10} {'late':>8}")
+    if not args.ramp:
+        report(await run_step(args.guilds, args, encode))
+        return
+
+    sustained = 0
+    count = args.start
+    while count <= args.guilds:
+        result = await run_step(count, args, encode)
+        report(result)
+        if result["late_ratio"] > args.late_threshold or result["streams"] < count:
+            break
+        sustained = count
+        count *= 2
+    print(f"Max sustainable concurrent streams: {sustained or 'below ' + str(args.start)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=100, help="fake guilds (the ramp's upper bound with --ramp)")
+    parser.add_argument("--seconds", type=float, default=20, help="steady-state window to measure")
+    parser.add_argument("--mode", choices=bot.PLAYBACK_MODES, default="pcm")
+    parser.add_argument("--queued", type=int, default=2, help="extra /play calls per guild that land in the queue")
+    parser.add_argument("--tracks", type=int, default=50, help="distinct songs across all guilds")
+    parser.add_argument("--latency", type=float, default=0.3, help="mean fake extraction latency in seconds")
+    parser.add_argument("--workers", type=int, default=4, help="extraction workers")
+    parser.add_argument("--max-pending", type=int, default=100000, help="extraction queue limit")
+    parser.add_argument("--ramp", action="store_true", help="double the guild count until frames run late")
+    parser.add_argument("--start", type=int, default=8, help="first ramp step")
+    parser.add_argument("--late-threshold", type=float, default=0.01, help="share of late frames a step may have")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, "fixture.webm")
+        FakeYoutubeDL.duration = int(args.seconds) + 30
+        make_fixture(fixture, FakeYoutubeDL.duration)
+        FakeYoutubeDL.fixture, server = serve_fixture(fixture)
+        FakeYoutubeDL.latency = args.latency
+        try:
+            asyncio.run(run(args))
+        finally:
+            server.shutdown()
+            bot.extraction_pool.shutdown()
+            bot.metadata_cache.close()
+
+if __name__ == "__main__":
+    main()
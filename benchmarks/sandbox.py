@@ -0,0 +1,14 @@
+"""Setup shared by the benchmarks; import it before `bot`.
+
+Makes the repository root importable and points the bot's caches and saved
+sessions at a temporary directory, so benchmark runs leave the working tree alone.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+tmp = tempfile.TemporaryDirectory()
+os.environ["CACHE_DIR"] = os.path.join(tmp.name, "cache")
+os.environ["DATA_DIR"] = os.path.join(tmp.name, "data")
@@ -0,0 +1,279 @@
+"""Stress test: hammer /skip, /remove, /stop, /shuffle and /play concurrently across many fake guilds.
+
+Uses the load test's fake guilds, voice clients and extractor with a short fixture,
+so tracks also end on their own while commands race each other. Some lookups can
+be made to fail to exercise the retry path.
+
+Every stream URL counts as expired, so each song change does a lookup and leaves
+a window for other commands to land in. Afterwards every guild must have settled
+into a consistent state: no double plays, nothing playing without a current song,
+no current song without audio and no queue left stalled behind an idle voice
+client. Then each guild gets a /stop while a song change is in flight, and
+must end up silent, and a song breaking off gets a /play during its retry delay,
+which must queue behind the songs already waiting. A /play after silence must
+not count as a track gap.
+
+Usage:
+    python benchmarks/stress_controls.py --guilds 50 --seconds 20
+    python benchmarks/stress_controls.py --guilds 200 --fail-rate 0.1
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord  # noqa: E402
+
+import sandbox  # noqa: E402  (must come before the bot)
+import loadtest  # noqa: E402
+from loadtest import FakeBot, FakeGuild, FakeInteraction, FakeVoiceClient, FakeYoutubeDL  # noqa: E402
+from bench_playback_modes import make_fixture, serve_fixture  # noqa: E402
+from extraction import ExtractionPool  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+
+bot = loadtest.bot
+
+class FlakyYoutubeDL(FakeYoutubeDL):
+    """Fails a share of lookups, like an unavailable video or a network blip"""
+    fail_rate = 0.0
+
+    def extract_info(self, url, download=False, process=True):
+        if random.random() < self.fail_rate:
+            time.sleep(self.latency)
+            raise Exception("simulated extraction failure")
+        return super().extract_info(url, download, process)
+
+class CountingVoiceClient(FakeVoiceClient):
+    """Counts attempts to start a second player while one is running"""
+    double_plays = 0
+
+    def play(self, source, *, after=None, **kwargs):
+        try:
+            super().play(source, after=after, **kwargs)
+        except discord.ClientException:
+            CountingVoiceClient.double_plays += 1
+            source.cleanup()
+            raise
+        self.playing_source = source
+
+    def break_off(self):
+        """Make the playing song fail mid-play, like a dropped stream"""
+        def read():
+            raise OSError("simulated stream failure")
+        self.playing_source.read = read
+
+class StressChannel(loadtest.FakeChannel):
+    async def connect(self, **kwargs):
+        self.guild.voice_client = CountingVoiceClient(self, self.encode)
+        return self.guild.voice_client
+
+class StressGuild(FakeGuild):
+    def __init__(self, guild_id):
+        super().__init__(guild_id, encode=False)
+        self.channel = StressChannel(self, False)
+
+async def hammer(music, guild, args, deadline, counts, errors):
+    """One guild's stream of random commands, several of them in flight at once"""
+    async def command(name):
+        interaction = FakeInteraction(guild)
+        queue = music.get_queue(guild.id)
+        try:
+            if name == "play":
+                await music.play.callback(music, interaction, f"stress track {random.randrange(args.tracks)}")
+            elif name == "skip":
+                await music.skip.callback(music, interaction)
+            elif name == "remove":
+                await music.remove.callback(music, interaction, random.randint(1, len(queue) + 1))
+            elif name == "stop":
+                await music.stop.callback(music, interaction)
+            elif name == "pause":
+                await music.pause.callback(music, interaction)
+            elif name == "resume":
+                await music.resume.callback(music, interaction)
+            elif name == "shuffle":
+                await music.shuffle.callback(music, interaction)
+            counts[name] += 1
+        except Exception as e:
+            errors[f"{name}: {type(e).__name__}: {e}"] += 1
+
+    weights = {"play": 5, "skip": 3, "remove": 3, "stop": 1, "pause": 1, "resume": 1, "shuffle": 1}
+    names, cum = list(weights), list(weights.values())
+    pending = set()
+    while time.monotonic() < deadline:
+        for _ in range(random.randint(1, args.burst)):
+            pending.add(asyncio.create_task(command(random.choices(names, cum)[0])))
+        await asyncio.sleep(random.uniform(0, args.interval * 2))
+        pending = {t for t in pending if not t.done()}
+    if pending:
+        await asyncio.wait(pending)
+
+async def stop_mid_transition(music, guild, args):
+    """Skip into a lookup and /stop while it is still running"""
+    await music.play.callback(music, FakeInteraction(guild), f"stress track {random.randrange(args.tracks)}")
+    await music.play.callback(music, FakeInteraction(guild), f"stress track {random.randrange(args.tracks)}")
+    await music.skip.callback(music, FakeInteraction(guild))
+    await asyncio.sleep(random.uniform(0, args.latency))
+    await music.stop.callback(music, FakeInteraction(guild))
+
+async def play_during_retry(music, guild, args):
+    """Break a song off with another queued and /play during the retry delay.
+
+    The broken song must be retried first and the new one must queue behind the
+    one already waiting, rather than starting straight away.
+    """
+    queue = music.get_queue(guild.id)
+    await music.play.callback(music, FakeInteraction(guild), f"stress track {random.randrange(args.tracks)}")
+    await music.play.callback(music, FakeInteraction(guild), f"stress track {random.randrange(args.tracks)}")
+    broken, waiting = queue.current, queue[0] if queue else None
+    if broken is None or waiting is None or not guild.voice_client.is_playing():
+        return "setup failed"
+    guild.voice_client.break_off()
+    await asyncio.sleep(bot.TRACK_RETRY_DELAY / 4)
+    await music.play.callback(music, FakeInteraction(guild), f"stress track {random.randrange(args.tracks)}")
+    late = queue[len(queue) - 1] if len(queue) == 2 else None
+    await asyncio.sleep(bot.TRACK_RETRY_DELAY + args.latency * 10)
+    if queue.current is not broken:
+        return "song that broke off was not retried"
+    if late is None or list(queue) != [waiting, late]:
+        return "/play during a retry jumped the queue"
+    return None
+
+def check(music, guild):
+    """Problems with a guild's settled state, if any"""
+    vc = guild.voice_client
+    queue = music.get_queue(guild.id)
+    controller = music.controllers.get(guild.id)
+    if controller is not None and (controller.lock.locked() or controller.events):
+        return None  # Tracks are short, so some guild is always between two songs
+    playing = vc is not None and (vc.is_playing() or vc.is_paused())
+    if playing and queue.current is None:
+        return "audio playing with no current song"
+    if not playing and queue.current is not None:
+        return "current song set but nothing playing"
+    if not playing and len(queue) and vc is not None and vc.is_connected():
+        return f"{len(queue)} song(s) stalled behind an idle voice client"
+    return None
+
+async def run(args):
+    bot.extraction_pool.shutdown()
+    bot.extraction_pool = ExtractionPool(bot.ytdl_format_options, workers=args.workers, max_pending=100000,
+                                         ytdl_class=FlakyYoutubeDL)
+    bot.metadata_cache.close()
+    # Every stream URL counts as expired, so each song change has to look it up again
+    bot.metadata_cache = MetadataCache(os.path.join(sandbox.tmp.name, "metadata.sqlite3"), stream_margin=float("inf"))
+    bot.STREAM_URL_MARGIN = float("inf")
+    bot.TRACK_RETRY_DELAY = 0.1
+
+    fake_bot = FakeBot(asyncio.get_running_loop())
+    music = bot.Music(fake_bot)
+    music.quotas = bot.Quotas()  # Commands arrive far faster than the per-guild limits allow
+    guilds = [StressGuild(20_000 + i) for i in range(args.guilds)]
+    fake_bot.guilds = guilds
+    for guild in guilds:
+        await guild.channel.connect()
+
+    counts, errors = Counter(), Counter()
+    started = time.monotonic()
+    await asyncio.gather(*(hammer(music, g, args, started + args.seconds, counts, errors) for g in guilds))
+    elapsed = time.monotonic() - started
+
+    # Let in-flight transitions and retries finish, then look for inconsistent guilds
+    await asyncio.sleep(args.settle)
+    problems = Counter()
+    for guild in guilds:
+        problem = check(music, guild)
+        if problem:
+            problems[problem] += 1
+
+    await asyncio.gather(*(stop_mid_transition(music, g, args) for g in guilds), return_exceptions=True)
+    await asyncio.sleep(args.settle)
+    for guild in guilds:
+        vc = guild.voice_client
+        if (vc and (vc.is_playing() or vc.is_paused())) or music.get_queue(guild.id).current:
+            problems["still playing after /stop"] += 1
+
+    # A /play while a broken song waits for its retry; lookups are made reliable for it
+    fail_rate, FlakyYoutubeDL.fail_rate = FlakyYoutubeDL.fail_rate, 0.0
+    retry_delay, bot.TRACK_RETRY_DELAY = bot.TRACK_RETRY_DELAY, 0.5
+    for guild in guilds:
+        music.reset_guild(guild.id)
+        if guild.voice_client:
+            guild.voice_client.stop()
+    await asyncio.sleep(args.settle)
+    for problem in await asyncio.gather(*(play_during_retry(music, g, args) for g in guilds)):
+        if problem:
+            problems[problem] += 1
+    FlakyYoutubeDL.fail_rate, bot.TRACK_RETRY_DELAY = fail_rate, retry_delay
+    for guild in guilds:
+        music.reset_guild(guild.id)
+        if guild.voice_client:
+            guild.voice_client.stop()
+    await asyncio.sleep(args.settle)
+
+    # Starting from silence isn't a track gap, however long the silence lasted
+    gaps = music.track_gaps.count
+    await asyncio.gather(*(music.play.callback(music, FakeInteraction(g), f"stress track {random.randrange(args.tracks)}")
+                           for g in guilds), return_exceptions=True)
+    if music.track_gaps.count != gaps:
+        problems[f"{music.track_gaps.count - gaps} idle period(s) recorded as track gaps"] += 1
+
+    for guild in guilds:
+        music.reset_guild(guild.id)
+        if guild.voice_client:
+            await guild.voice_client.disconnect()
+    await asyncio.sleep(1.0)
+    music.idle_tracker.cancel_all()
+    leaked = bot.live_ffmpeg_processes()
+
+    total = sum(counts.values())
+    print(f"{args.guilds} guilds, {total} commands in {elapsed:.1f}s ({total / elapsed:.0f}/s): "
+          + ", ".join(f"{name} {n}" for name, n in counts.most_common()))
+    retries = {labels[0]: int(n) for labels, n in bot.track_retries.values.items()}
+    print(f"Track retries: {retries.get('retried', 0)} retried, {retries.get('gave_up', 0)} given up")
+    print(f"Double plays: {CountingVoiceClient.double_plays}")
+    print(f"ffmpeg processes left after teardown: {leaked}")
+    for error, n in errors.most_common(10):
+        print(f"  command error x{n}: {error}")
+    for problem, n in problems.most_common():
+        print(f"  {n} guild(s): {problem}")
+    ok = not problems and not CountingVoiceClient.double_plays and not errors and not leaked
+    print("OK" if ok else "FAILED")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=20, help="how long to keep hammering")
+    parser.add_argument("--track-seconds", type=int, default=3, help="fixture length; short so tracks also end naturally")
+    parser.add_argument("--tracks", type=int, default=20, help="distinct songs across all guilds")
+    parser.add_argument("--burst", type=int, default=3, help="most commands a guild fires at once")
+    parser.add_argument("--interval", type=float, default=0.5, help="mean seconds between a guild's bursts")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean fake extraction latency in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.05, help="share of lookups that fail")
+    parser.add_argument("--workers", type=int, default=8, help="extraction workers")
+    parser.add_argument("--settle", type=float, default=3, help="seconds to wait before checking final state")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, "fixture.webm")
+        make_fixture(fixture, args.track_seconds)
+        FakeYoutubeDL.fixture, server = serve_fixture(fixture)
+        FakeYoutubeDL.duration = args.track_seconds
+        FakeYoutubeDL.latency = args.latency
+        FlakyYoutubeDL.fail_rate = args.fail_rate
+        try:
+            ok = asyncio.run(run(args))
+        finally:
+            server.shutdown()
+            bot.extraction_pool.shutdown()
+            bot.metadata_cache.close()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import time
+PROCESS_STARTED = time.perf_counter()
 import os
 import certifi
 os.environ["SSL_CERT_FILE"] = certifi.where()
@@ -5,11 +7,29 @@ import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
-import yt_dlp as youtube_dl
+from extraction import ExtractionBusy, ExtractionError, ExtractionPool
+from metadata_cache import MetadataCache, normalize_key
+from audio_cache import AudioCache
+from shared_audio import SharedSource, SharedStreams
+from queue_store import QueueStore
+from search_index import DebouncedSearch, SearchIndex
+from quality import PROFILES, CpuSampler, LoadMonitor, parse_thresholds
+from quotas import QuotaExceeded, Quotas
+import metrics
 import asyncio
 import logging
-from typing import Optional, List
+import random
+import signal
+import subprocess
+import weakref
+from collections import deque
+from itertools import islice
+from typing import Callable, Deque, Dict, Iterable, Optional, List
+from urllib.parse import parse_qs, urlparse
 import datetime
+import functools
+import hashlib
+import json
 
 # Setup logging
 logging.basicConfig(
@@ -18,19 +38,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+startup_phases = {}
+
+def mark_startup(phase: str):
+    """Log how long after launch a startup phase finished, once per process"""
+    if phase not in startup_phases:
+        startup_phases[phase] = time.perf_counter() - PROCESS_STARTED
+        logger.info(f"Startup: {phase} after {startup_phases[phase]:.2f}s")
+
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-if not TOKEN:
-    logger.error("DISCORD_TOKEN not found in environment variables")
-    print("❌ DISCORD_TOKEN not found in environment variables")
-    print("Please set DISCORD_TOKEN in Railway Variables")
-    exit(1)
+# Playback mode: "pcm" decodes to PCM and re-encodes in Python (volume control in-process),
+# "opus" hands Opus packets straight to discord.py and copies Opus/WebM streams untouched
+PLAYBACK_MODES = ("pcm", "opus")
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "pcm").lower()
+if PLAYBACK_MODE not in PLAYBACK_MODES:
+    logger.warning(f"Unknown PLAYBACK_MODE {PLAYBACK_MODE!r}, falling back to 'pcm'")
+    PLAYBACK_MODE = "pcm"
+
+# How many upcoming tracks get their stream URL resolved ahead of time
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "3"))
+# Start ffmpeg for the next track this many seconds before the current one ends (0 disables)
+PREFETCH_WARM_SECONDS = float(os.getenv("PREFETCH_WARM_SECONDS", "0"))
 
 # YouTube DL configuration
 ytdl_format_options = {
-    'format': 'bestaudio/best',
+    # Opus formats play in opus mode without a transcode
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
@@ -46,16 +82,166 @@ ytdl_format_options = {
     'prefer_ffmpeg': True,
 }
 
+# Audio-only streams carry their codec parameters in the header, so ffmpeg needn't
+# read ahead to probe them before producing the first frame
+FFMPEG_INPUT_OPTIONS = os.getenv("FFMPEG_INPUT_OPTIONS", "-probesize 32k -analyzeduration 0")
+
 ffmpeg_options = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn -b:a 192k'
+    'before_options': f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 {FFMPEG_INPUT_OPTIONS}',
+    'options': '-vn'
 }
 
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+# Extraction runs in its own pool, each worker holding a private YoutubeDL instance
+extraction_pool = ExtractionPool(
+    ytdl_format_options,
+    workers=int(os.getenv("EXTRACT_WORKERS", "4")),
+    backend=os.getenv("EXTRACT_BACKEND", "thread"),
+    max_pending=int(os.getenv("EXTRACT_QUEUE_LIMIT", "64")),
+)
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+# New streams start with a cheaper quality profile while CPU use or the number of live
+# streams is past these thresholds (one step down per threshold crossed)
+load_monitor = LoadMonitor(
+    PROFILES,
+    cpu_thresholds=parse_thresholds(os.getenv("QUALITY_CPU_THRESHOLDS", "0.7,0.85"), len(PROFILES) - 1),
+    stream_thresholds=parse_thresholds(os.getenv("QUALITY_STREAM_THRESHOLDS"), len(PROFILES) - 1),
+    recover_after=float(os.getenv("QUALITY_RECOVER_SECONDS", "60")),
+)
+QUALITY_CHECK_INTERVAL = float(os.getenv("QUALITY_CHECK_INTERVAL", "5"))
+
+def probe_codec(data) -> Optional[str]:
+    """Return 'opus' when the extracted format is already Opus encoded"""
+    acodec = (data.get('acodec') or '').lower()
+    if acodec == 'opus' or acodec.startswith('opus.'):
+        return 'opus'
+    return None
+
+# Fallback lifetime for stream URLs that don't carry an expiry timestamp
+STREAM_URL_TTL = 4 * 60 * 60
+# Re-resolve this long before the URL actually expires so it can't die mid-song
+STREAM_URL_MARGIN = 10 * 60
+
+def stream_url_expiry(url: Optional[str]) -> float:
+    """Unix time at which a stream URL stops working"""
+    if url:
+        query = parse_qs(urlparse(url).query)
+        try:
+            return float(query['expire'][0])
+        except (KeyError, IndexError, ValueError):
+            pass
+    return time.time() + STREAM_URL_TTL
+
+# Seconds the bot stays in a voice channel with no listeners
+IDLE_DISCONNECT_SECONDS = float(os.getenv("IDLE_DISCONNECT_SECONDS", "30"))
+
+# Songs taken from a single playlist link
+PLAYLIST_LIMIT = int(os.getenv("PLAYLIST_LIMIT", "5000"))
+# Minimum seconds between progress edits of the playlist embed
+PLAYLIST_PROGRESS_INTERVAL = 2.0
+
+def is_playlist_url(query: str) -> bool:
+    """Whether /play was given a playlist rather than a single song"""
+    parsed = urlparse(query.strip())
+    if parsed.scheme not in ('http', 'https'):
+        return False
+    params = parse_qs(parsed.query)
+    if parsed.path == '/playlist' and 'list' in params:
+        return True
+    if 'list' in params and 'v' not in params and parsed.netloc.lower().endswith('youtube.com'):
+        return True
+    return '/sets/' in parsed.path and parsed.netloc.lower().endswith('soundcloud.com')
+
+# /play autocomplete: titles remembered for suggestions, and results fetched per background search
+AUTOCOMPLETE_INDEX_SIZE = int(os.getenv("AUTOCOMPLETE_INDEX_SIZE", "5000"))
+AUTOCOMPLETE_SEARCH_RESULTS = int(os.getenv("AUTOCOMPLETE_SEARCH_RESULTS", "5"))
+
+def is_url(query: str) -> bool:
+    return urlparse(query.strip()).scheme in ('http', 'https')
+
+# Extra attempts for a track that fails to start or errors mid-play, and the pause before each
+TRACK_RETRIES = int(os.getenv("TRACK_RETRIES", "1"))
+TRACK_RETRY_DELAY = float(os.getenv("TRACK_RETRY_DELAY", "2"))
+
+# Admission limits for /play (0 disables a limit): per-guild rate with bursts, queue length and
+# lookups at once, plus a global rate and the number of voice streams playing
+PLAY_RATE_PER_MINUTE = float(os.getenv("PLAY_RATE_PER_MINUTE", "20"))
+PLAY_BURST = int(os.getenv("PLAY_BURST", "5"))
+GLOBAL_PLAY_RATE_PER_MINUTE = float(os.getenv("GLOBAL_PLAY_RATE_PER_MINUTE", "0"))
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", str(PLAYLIST_LIMIT)))
+GUILD_LOOKUP_LIMIT = int(os.getenv("GUILD_LOOKUP_LIMIT", "3"))
+MAX_VOICE_STREAMS = int(os.getenv("MAX_VOICE_STREAMS", "0"))
+
+# Minimum seconds between edits of a guild's now-playing message
+NOW_PLAYING_INTERVAL = float(os.getenv("NOW_PLAYING_INTERVAL", "5"))
+
+# Durable state such as saved queues lives here
+DATA_DIR = os.getenv("DATA_DIR", "data")
+# How often the playback position of playing guilds is saved
+POSITION_SAVE_INTERVAL = 15.0
+
+# yt-dlp lookups are cached on disk so a redeploy doesn't cold-start every song
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+metadata_cache = MetadataCache(
+    os.path.join(CACHE_DIR, "metadata.sqlite3"),
+    memory_size=int(os.getenv("METADATA_CACHE_SIZE", "1024")),
+    metadata_ttl=float(os.getenv("METADATA_CACHE_TTL", str(7 * 24 * 3600))),
+    stream_margin=STREAM_URL_MARGIN,
+)
+
+# Popular tracks can be kept on disk as Ogg/Opus and played without streaming or transcoding
+AUDIO_CACHE_MB = int(os.getenv("AUDIO_CACHE_MB", "0"))
+audio_cache = AudioCache(
+    os.path.join(CACHE_DIR, "audio"),
+    max_bytes=AUDIO_CACHE_MB * 2 ** 20,
+    min_plays=int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3")),
+    before_options=ffmpeg_options['before_options'],
+) if AUDIO_CACHE_MB > 0 else None
+
+# Guilds starting the same song within this many seconds of each other share one ffmpeg
+# process (0 disables). Buffers cost about 20 KB per second in opus mode, 190 KB in pcm mode.
+SHARED_STREAM_SECONDS = float(os.getenv("SHARED_STREAM_SECONDS", "0"))
+shared_streams = SharedStreams(buffer_seconds=SHARED_STREAM_SECONDS) if SHARED_STREAM_SECONDS > 0 else None
+
+# Optional Prometheus endpoint; leave METRICS_PORT unset to disable it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+extraction_seconds = metrics.Histogram("musicbot_extraction_seconds", "yt-dlp extraction latency, cache misses only", ("outcome",))
+ffmpeg_spawn_seconds = metrics.Histogram("musicbot_ffmpeg_spawn_seconds", "Time to spawn ffmpeg for a track", ("mode",))
+command_seconds = metrics.Histogram("musicbot_command_seconds", "Slash command handling time", ("command", "outcome"))
+track_gap_seconds = metrics.Histogram("musicbot_track_gap_seconds", "Silence between the end of one track and the start of the next")
+loop_lag_seconds = metrics.Histogram("musicbot_event_loop_lag_seconds", "How late the event loop runs a scheduled wakeup")
+quota_rejections = metrics.Counter("musicbot_rejected_requests_total", "Requests turned away by admission limits", ("reason",))
+track_retries = metrics.Counter("musicbot_track_retries_total", "Failed tracks retried or given up on", ("outcome",))
+loop_lag = metrics.Gauge("musicbot_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+
+# ffmpeg-backed sources, so the live process count can be read at scrape time
+ffmpeg_sources = weakref.WeakSet()
+
+def live_ffmpeg_processes() -> int:
+    return sum(1 for source in list(ffmpeg_sources)
+               if isinstance(getattr(source, '_process', None), subprocess.Popen) and source._process.poll() is None)
+
+metrics.Gauge("musicbot_ffmpeg_processes", "Running ffmpeg subprocesses", callback=live_ffmpeg_processes)
+metrics.Gauge("musicbot_extraction_backlog", "Extractions waiting for a worker", callback=lambda: extraction_pool.backlog)
+metrics.Gauge("musicbot_extraction_running", "Extractions in progress", callback=lambda: extraction_pool.running)
+metrics.Gauge("musicbot_metadata_cache_hit_ratio", "Share of lookups served from the metadata cache", callback=metadata_cache.hit_ratio)
+if audio_cache is not None:
+    metrics.Gauge("musicbot_audio_cache_hit_ratio", "Share of plays served from the audio cache", callback=audio_cache.hit_ratio)
+    metrics.Gauge("musicbot_audio_cache_bytes", "Size of the audio cache on disk", callback=lambda: audio_cache.total_bytes)
+    metrics.Gauge("musicbot_audio_cache_events", "Audio cache hits, misses, stores, failures and evictions", ("event",),
+                  callback=lambda: {(event,): count for event, count in audio_cache.stats.items()})
+if shared_streams is not None:
+    metrics.Gauge("musicbot_shared_streams", "Decoders that other guilds can join", callback=lambda: len(shared_streams.streams))
+    metrics.Gauge("musicbot_shared_stream_consumers", "Voice clients reading from a shared decoder", callback=shared_streams.consumers)
+    metrics.Gauge("musicbot_shared_stream_plays", "Plays that opened a shared decoder or joined one", ("event",),
+                  callback=lambda: {(event,): count for event, count in shared_streams.stats.items()})
+
+class TrackMetadata:
+    """Song details shared by queue entries and audio sources"""
+    __slots__ = ()
+
+    def _set_metadata(self, data):
         self.data = data
         self.title = data.get('title', 'Unknown')
         self.url = data.get('url')
@@ -64,23 +250,182 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.duration = data.get('duration', 0)
         self.webpage_url = data.get('webpage_url', '')
 
+    def format_duration(self):
+        """Format duration to MM:SS"""
+        if self.duration and self.duration > 0:
+            minutes = int(self.duration) // 60
+            seconds = int(self.duration) % 60
+            return f"{minutes}:{seconds:02d}"
+        return "Unknown"
+
+class Track(TrackMetadata):
+    """A queued song. Only metadata is kept; ffmpeg is spawned when the track is about to play."""
+    __slots__ = ('title', 'duration', 'webpage_url', 'thumbnail', 'uploader', 'requester',
+                 'stream_url', 'acodec', 'expires_at')
+
+    def __init__(self, title, *, duration=0, webpage_url='', thumbnail=None, uploader='Unknown',
+                 requester=None, stream_url=None, acodec=None):
+        self.title = title
+        self.duration = duration or 0
+        self.webpage_url = webpage_url
+        self.thumbnail = thumbnail
+        self.uploader = uploader
+        self.requester = requester
+        self.stream_url = stream_url
+        self.acodec = acodec
+        self.expires_at = stream_url_expiry(stream_url) if stream_url else 0.0
+
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False, timeout=30):
-        loop = loop or asyncio.get_event_loop()
+    def from_data(cls, data, requester=None):
+        return cls(
+            data.get('title', 'Unknown'),
+            duration=data.get('duration', 0),
+            webpage_url=data.get('webpage_url', ''),
+            thumbnail=data.get('thumbnail'),
+            uploader=data.get('uploader', 'Unknown'),
+            requester=requester,
+            stream_url=data.get('url'),
+            acodec=data.get('acodec'),
+        )
 
-        def extract():
-            try:
-                return ytdl.extract_info(url, download=not stream)
-            except Exception as e:
-                logger.error(f"Error extracting info: {str(e)}")
-                raise Exception(f"Error extracting info: {str(e)}")
+    @classmethod
+    def from_entry(cls, entry, requester=None):
+        """Build a track from a flat playlist entry, which has no stream URL yet"""
+        thumbnails = entry.get('thumbnails') or []
+        return cls(
+            entry.get('title') or 'Unknown',
+            duration=entry.get('duration') or 0,
+            webpage_url=entry.get('webpage_url') or entry.get('url', ''),
+            thumbnail=entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None),
+            uploader=entry.get('uploader') or entry.get('channel') or 'Unknown',
+            requester=requester,
+        )
+
+    def refresh(self, data):
+        """Take a freshly resolved stream URL"""
+        self.stream_url = data.get('url')
+        self.acodec = data.get('acodec')
+        self.expires_at = stream_url_expiry(self.stream_url)
+
+    def is_stale(self) -> bool:
+        return not self.stream_url or time.time() > self.expires_at - STREAM_URL_MARGIN
+
+    def to_state(self):
+        """Compact form for the queue store"""
+        return [self.title, self.duration, self.webpage_url, self.thumbnail, self.uploader,
+                self.requester, self.stream_url, self.acodec, self.expires_at]
+
+    @classmethod
+    def from_state(cls, state):
+        title, duration, webpage_url, thumbnail, uploader, requester, stream_url, acodec, expires_at = state
+        track = cls(title, duration=duration, webpage_url=webpage_url, thumbnail=thumbnail,
+                    uploader=uploader, requester=requester)
+        track.stream_url = stream_url
+        track.acodec = acodec
+        track.expires_at = expires_at
+        return track
+
+    def to_data(self):
+        """Info dict in the shape the audio sources expect"""
+        return {
+            'title': self.title,
+            'url': self.stream_url,
+            'thumbnail': self.thumbnail,
+            'uploader': self.uploader,
+            'duration': self.duration,
+            'webpage_url': self.webpage_url,
+            'acodec': self.acodec,
+        }
+
+class YTDLSource(TrackMetadata, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5):
+        super().__init__(source, volume)
+        self._set_metadata(data)
 
+    @classmethod
+    def create(cls, filename, *, data, mode="pcm", volume=None, seek=0.0, profile=None):
+        """Build the audio source for an already extracted song, optionally starting part way in"""
+        profile = profile or load_monitor.profile
+        with ffmpeg_spawn_seconds.time(mode):
+            if shared_streams is not None and seek <= 0 and data.get('webpage_url') and (mode != "opus" or volume in (None, 1.0)):
+                source = cls.create_shared(filename, data=data, mode=mode, volume=volume, profile=profile)
+            elif mode == "opus":
+                source = YTDLOpusSource(filename, data=data, volume=1.0 if volume is None else volume, seek=seek, profile=profile)
+                ffmpeg_sources.add(source)
+            else:
+                source = cls(cls._spawn_pcm(filename, seek), data=data, volume=0.5 if volume is None else volume)
+        source.profile = profile
+        return source
+
+    @staticmethod
+    def _spawn_pcm(filename, seek=0.0):
+        options = dict(ffmpeg_options)
+        if seek > 0:
+            options['before_options'] = f"{options['before_options']} -ss {seek:.2f}"
+        audio = discord.FFmpegPCMAudio(filename, **options)
+        ffmpeg_sources.add(audio)
+        return audio
+
+    @classmethod
+    def create_shared(cls, filename, *, data, mode="pcm", volume=None, profile=None):
+        """Join another guild's decode of the same song if it only just started, else start one others can join"""
+        # Sources are built for a quality profile, so only guilds on the same one share a decode
+        key = (normalize_key(data['webpage_url']), mode, profile.name)
+        if mode == "opus":
+            def spawn_opus(seek=0.0):
+                source = YTDLOpusSource(filename, data=data, seek=seek, profile=profile)
+                ffmpeg_sources.add(source)
+                return source
+            return shared_streams.consume(key, spawn_opus, spawn_opus, consumer_class=functools.partial(SharedOpusSource, data=data))
+        consumer = shared_streams.consume(key, lambda: cls._spawn_pcm(filename), lambda seek: cls._spawn_pcm(filename, seek))
+        return cls(consumer, data=data, volume=0.5 if volume is None else volume)
+
+    @classmethod
+    def create_cached(cls, path, *, data, mode="pcm", volume=None, seek=0.0):
+        """Build the audio source for a track from the audio cache"""
+        if mode == "opus" and volume in (None, 1.0):
+            source = CachedOpusSource(path, data=data, seek=seek)
+        else:
+            with ffmpeg_spawn_seconds.time("cached"):
+                # Local file: no reconnect options, and decoding Opus is all ffmpeg has to do
+                audio = discord.FFmpegPCMAudio(path, before_options=f"-ss {seek:.2f}" if seek > 0 else None, options='-vn')
+                ffmpeg_sources.add(audio)
+                source = cls(audio, data=data, volume=0.5 if volume is None else volume)
+        source.profile = load_monitor.profile
+        return source
+
+    @classmethod
+    async def extract_info(cls, url, *, loop=None, timeout=30, guild_id=0, fresh_stream=True):
+        """Resolve a URL or search term to the info dict of a single song.
+
+        Lookups go through the metadata cache. Pass fresh_stream=False when
+        metadata is enough; the result may then lack 'url' and be resolved again later.
+        """
+        try:
+            cached = await metadata_cache.get(url, fresh_stream=fresh_stream)
+        except Exception as e:
+            logger.warning(f"Metadata cache read failed: {e}")
+            cached = None
+        if cached:
+            return cached
+
+        started = time.perf_counter()
         try:
-            data = await asyncio.wait_for(loop.run_in_executor(None, extract), timeout)
+            data = await asyncio.wait_for(extraction_pool.extract(url, guild_id=guild_id), timeout)
+        except ExtractionBusy as e:
+            extraction_seconds.observe(time.perf_counter() - started, "busy")
+            raise Exception(f"⏳ {str(e)}")
+        except ExtractionError as e:
+            extraction_seconds.observe(time.perf_counter() - started, "error")
+            logger.error(f"Error extracting info: {str(e)}")
+            raise Exception(f"❌ Error: Error extracting info: {str(e)}")
         except asyncio.TimeoutError:
+            extraction_seconds.observe(time.perf_counter() - started, "timeout")
             raise Exception("⏱️ Timeout while fetching media. Please try another song or check your connection.")
         except Exception as e:
+            extraction_seconds.observe(time.perf_counter() - started, "error")
             raise Exception(f"❌ Error: {str(e)}")
+        extraction_seconds.observe(time.perf_counter() - started, "ok")
 
         if not data:
             raise Exception("❌ Could not find any audio to play.")
@@ -90,65 +435,880 @@ class YTDLSource(discord.PCMVolumeTransformer):
                 raise Exception("❌ No playable entries found.")
             data = data['entries'][0]
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        
         try:
-            return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+            await metadata_cache.put(url, data, stream_url_expiry(data.get('url')))
+        except Exception as e:
+            logger.warning(f"Metadata cache write failed: {e}")
+        return data
+
+    @classmethod
+    async def from_track(cls, track: Track, *, loop=None, timeout=30, mode=None, volume=None, guild_id=0, seek=0.0):
+        """Materialize a queued track, re-resolving its stream URL if it has gone stale"""
+        cache_key = normalize_key(track.webpage_url) if audio_cache is not None and track.webpage_url else None
+        if cache_key:
+            path = audio_cache.lookup(cache_key)
+            if path:
+                try:
+                    return cls.create_cached(path, data=track.to_data(), mode=mode or PLAYBACK_MODE, volume=volume, seek=seek)
+                except Exception as e:
+                    logger.warning(f"Cached audio for {track.title} unusable, streaming instead: {e}")
+
+        if track.is_stale():
+            data = await cls.extract_info(track.webpage_url, loop=loop, timeout=timeout, guild_id=guild_id)
+            track.refresh(data)
+        if cache_key:
+            audio_cache.record_play(cache_key, track.stream_url, duration=track.duration, opus=probe_codec(track.to_data()) == 'opus')
+
+        try:
+            return cls.create(track.stream_url, data=track.to_data(), mode=mode or PLAYBACK_MODE, volume=volume, seek=seek)
         except Exception as e:
             raise Exception(f"❌ FFmpeg error: {str(e)}")
 
-    def format_duration(self):
-        """Format duration to MM:SS"""
-        if self.duration and self.duration > 0:
-            minutes = self.duration // 60
-            seconds = self.duration % 60
-            return f"{minutes}:{seconds:02d}"
-        return "Unknown"
+class YTDLOpusSource(TrackMetadata, discord.FFmpegOpusAudio):
+    """Opus packets straight from ffmpeg, skipping the PCM decode and Python volume scaling.
+
+    Opus streams (YouTube's WebM/Opus formats) are copied through without transcoding.
+    Volume is applied with an ffmpeg filter only when it differs from 1.0, which forces
+    a libopus re-encode for that song. Re-encodes use the quality profile's bitrate
+    and compression level.
+    """
+
+    def __init__(self, filename, *, data, volume=1.0, seek=0.0, profile=None):
+        profile = profile or load_monitor.profile
+        codec = probe_codec(data)
+        before_options = ffmpeg_options['before_options']
+        options = ffmpeg_options['options']
+        if seek > 0:
+            before_options = f"{before_options} -ss {seek:.2f}"
+        if volume != 1.0:
+            codec = None
+            options = f"{options} -filter:a volume={volume:.2f}"
+        if codec != 'opus':
+            options = f"{options} -compression_level {profile.compression_level}"
+        super().__init__(
+            filename,
+            bitrate=profile.bitrate,
+            codec=codec,
+            before_options=before_options,
+            options=options,
+        )
+        self._set_metadata(data)
+        self.volume = volume
+        self.passthrough = codec == 'opus'
+
+class SharedOpusSource(TrackMetadata, SharedSource):
+    """Opus packets from a decode shared with other guilds playing the same song"""
+
+    def __init__(self, streams, key, *, spawn, fallback, data):
+        super().__init__(streams, key, spawn=spawn, fallback=fallback)
+        self._set_metadata(data)
+        self.volume = 1.0
+        self.passthrough = probe_codec(data) == 'opus'
+
+    def is_opus(self):
+        return True
+
+class CachedOpusSource(TrackMetadata, discord.AudioSource):
+    """Opus packets read straight from a cached Ogg file, without an ffmpeg process"""
+
+    def __init__(self, path, *, data, seek=0.0):
+        self._set_metadata(data)
+        self.volume = 1.0
+        self.passthrough = True
+        self.file = open(path, 'rb')
+        self.packets = discord.oggparse.OggStream(self.file).iter_packets()
+        # Packets are 20 ms each, so seeking is a matter of skipping them; done on the audio thread
+        self.skip = int(seek / 0.02)
+
+    def read(self) -> bytes:
+        try:
+            while True:
+                packet = next(self.packets)
+                if packet.startswith((b'OpusHead', b'OpusTags')):
+                    continue
+                if self.skip:
+                    self.skip -= 1
+                    continue
+                return packet
+        except (StopIteration, discord.oggparse.OggError, ValueError):
+            return b''
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self.file.close()
+
+LOOP_MODES = ("off", "one", "all")
+QUEUE_PAGE_SIZE = 10
+
+# libopus OPUS_SET_COMPLEXITY request; discord.py's Encoder has no setter for it
+OPUS_SET_COMPLEXITY = 4010
+
+class ProfileEncoder(discord.opus.Encoder):
+    """The Opus encoder discord.py uses for PCM sources, configured for a quality profile.
+
+    Complexity is what makes libopus cheaper to run; bitrate and bandwidth only shrink
+    the packets.
+    """
+
+    def __init__(self, profile):
+        super().__init__()
+        self.profile = profile
+        self.set_bitrate(profile.bitrate)
+        self.set_bandwidth(profile.bandwidth)
+        discord.opus._lib.opus_encoder_ctl(self._state, OPUS_SET_COMPLEXITY, profile.compression_level)
 
 class MusicQueue:
-    def __init__(self):
-        self.queue: List[YTDLSource] = []
-        self.current: Optional[YTDLSource] = None
-        self.loop = False
+    """Upcoming tracks for a guild.
+
+    Kept in a list with a moving head: advancing only bumps the head, and played
+    slots are trimmed in one go once they make up half the list, so advancing is
+    amortised O(1) while removal by position and page rendering stay a single list
+    delete or slice. With shuffle on, the next track is picked ahead of time, so
+    "Next Up" and prefetching see the song that will actually play.
+    """
+
+    def __init__(self, on_change=None):
+        self.tracks: List[Optional[Track]] = []
+        self.head = 0  # Index in tracks of the first queued entry; slots before it are played
+        self.current: Optional[Track] = None
+        self.loop_mode = "off"
         self.shuffle = False
+        self.shuffle_next: Optional[int] = None  # Queue position of the track shuffle plays next
+        self.skipped = False  # Set by /skip so loop-one moves on instead of repeating
+        self.on_change = on_change
+        # Playback position of the current track: seconds played before started_at, plus time since
+        self.offset = 0.0
+        self.started_at: Optional[float] = None
 
-    def add(self, item: YTDLSource):
-        self.queue.append(item)
+    def touch(self):
+        """Report a change, e.g. to the queue store"""
+        if self.on_change:
+            self.on_change()
 
-    def remove(self, index: int) -> Optional[YTDLSource]:
-        if 0 <= index < len(self.queue):
-            return self.queue.pop(index)
+    def add(self, item: Track):
+        self.tracks.append(item)
+        self.touch()
+
+    def extend(self, items: Iterable[Track]):
+        """Append tracks without reporting a change, e.g. when restoring a saved queue"""
+        self.tracks.extend(items)
+
+    def push_front(self, item: Track):
+        if self.head:
+            self.head -= 1
+            self.tracks[self.head] = item
+        else:
+            self.tracks.insert(0, item)
+        if self.shuffle_next is not None:
+            self.shuffle_next += 1
+        self.touch()
+
+    def remove(self, index: int) -> Optional[Track]:
+        if 0 <= index < len(self):
+            item = self.tracks.pop(self.head + index)
+            if self.shuffle_next is not None:
+                if index == self.shuffle_next:
+                    self.shuffle_next = None
+                elif index < self.shuffle_next:
+                    self.shuffle_next -= 1
+            self.touch()
+            return item
         return None
 
+    def _pop_first(self) -> Track:
+        item = self.tracks[self.head]
+        self.tracks[self.head] = None
+        self.head += 1
+        if self.head * 2 >= len(self.tracks):
+            del self.tracks[:self.head]
+            self.head = 0
+        if self.shuffle_next is not None:
+            self.shuffle_next = self.shuffle_next - 1 if self.shuffle_next else None
+        return item
+
     def clear(self):
-        self.queue.clear()
+        self.tracks.clear()
+        self.head = 0
+        self.shuffle_next = None
         self.current = None
+        self.skipped = False
+        self.offset = 0.0
+        self.started_at = None
+        self.touch()
+
+    def mark_started(self, offset: float = 0.0):
+        self.offset = offset
+        self.started_at = time.monotonic()
+        self.touch()
+
+    def mark_paused(self):
+        if self.started_at is not None:
+            self.offset += time.monotonic() - self.started_at
+            self.started_at = None
+            self.touch()
+
+    def mark_resumed(self):
+        if self.started_at is None and self.current:
+            self.started_at = time.monotonic()
+            self.touch()
 
-    def get_next(self) -> Optional[YTDLSource]:
-        if not self.queue:
+    @property
+    def paused(self) -> bool:
+        return self.current is not None and self.started_at is None
+
+    def position(self) -> float:
+        """Seconds into the current track"""
+        if self.started_at is None:
+            return self.offset
+        return self.offset + time.monotonic() - self.started_at
+
+    def _shuffle_pick(self) -> int:
+        """Queue position shuffle plays next, chosen once and kept until it plays or leaves"""
+        if self.shuffle_next is None:
+            self.shuffle_next = random.randrange(len(self))
+        return self.shuffle_next
+
+    def get_next(self) -> Optional[Track]:
+        """Pick the track to play after the current one, honouring loop and shuffle"""
+        self.touch()
+        skipped, self.skipped = self.skipped, False
+        if self.loop_mode == "one" and self.current and not skipped:
+            return self.current
+        if self.loop_mode == "all" and self.current:
+            self.tracks.append(self.current)
+        if not len(self):
             return None
-        return self.queue.pop(0)
+        if self.shuffle:
+            return self.remove(self._shuffle_pick())
+        return self._pop_first()
+
+    def peek(self, count: int) -> List[Track]:
+        """The next few tracks to play; with shuffle on only the next one is known"""
+        if not len(self):
+            return []
+        if self.shuffle:
+            return [self[self._shuffle_pick()]]
+        return self.tracks[self.head:self.head + count]
+
+    def up_next(self) -> Optional[Track]:
+        """The track get_next will move on to, unless the queue changes first"""
+        tracks = self.peek(1)
+        return tracks[0] if tracks else None
+
+    def page(self, number: int, size: int = QUEUE_PAGE_SIZE) -> List[Track]:
+        """Tracks on a 1-based page"""
+        start = self.head + max(0, (number - 1) * size)
+        return self.tracks[start:self.head + number * size]
+
+    def page_count(self, size: int = QUEUE_PAGE_SIZE) -> int:
+        return max(1, -(-len(self) // size))
 
     def __len__(self):
-        return len(self.queue)
+        return len(self.tracks) - self.head
+
+    def __iter__(self):
+        return islice(self.tracks, self.head, None)
+
+    def __getitem__(self, index: int) -> Track:
+        if not -len(self) <= index < len(self):
+            raise IndexError("queue index out of range")
+        return self.tracks[self.head + index % len(self)]
+
+class Prefetcher:
+    """Resolves stream URLs for the next few queued tracks while the current one plays.
+
+    Optionally warms the next track's ffmpeg process shortly before the current song ends,
+    so the transition only has to hand an already running source to the voice client.
+    """
+
+    def __init__(self, music: "Music", guild: discord.Guild):
+        self.music = music
+        self.guild = guild
+        self.tasks: Dict[Track, asyncio.Task] = {}
+        self.warm_track: Optional[Track] = None
+        self.warm_source = None
+        self.warm_handle: Optional[asyncio.TimerHandle] = None
+        self.warm_task: Optional[asyncio.Task] = None
+
+    def schedule(self):
+        """Start resolving any stale tracks among the next PREFETCH_DEPTH entries"""
+        queue = self.music.get_queue(self.guild.id)
+        for track in queue.peek(PREFETCH_DEPTH):
+            if track.is_stale() and track not in self.tasks:
+                task = asyncio.create_task(self._resolve(track))
+                self.tasks[track] = task
+                task.add_done_callback(lambda t, track=track: self._forget(track, t))
+
+    def _forget(self, track, task):
+        if self.tasks.get(track) is task:
+            del self.tasks[track]
+
+    async def _resolve(self, track: Track):
+        try:
+            data = await YTDLSource.extract_info(track.webpage_url, loop=self.music.bot.loop, guild_id=self.guild.id)
+        except Exception as e:
+            logger.warning(f"Prefetch failed for {track.title} in guild {self.guild.id}: {e}")
+            return
+        track.refresh(data)
+
+    async def ready(self, track: Track):
+        """Wait for an in-flight resolve of this track, if there is one"""
+        task = self.tasks.get(track)
+        if task:
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+
+    def warm_after(self, delay: float):
+        """Spawn ffmpeg for the next track after delay seconds"""
+        if PREFETCH_WARM_SECONDS <= 0:
+            return
+        if self.warm_handle:
+            self.warm_handle.cancel()
+        self.warm_handle = self.music.bot.loop.call_later(max(0.0, delay), self._warm)
+
+    def _warm(self):
+        self.warm_handle = None
+        queue = self.music.get_queue(self.guild.id)
+        track = queue.up_next()
+        if track is None or track is self.warm_track:
+            return
+        self.drop_warm()
+        self.schedule()
+
+        async def warm():
+            await self.ready(track)
+            if track.is_stale() or queue.up_next() is not track:
+                return
+            try:
+                self.warm_source = YTDLSource.create(track.stream_url, data=track.to_data(), mode=self.music.get_playback_mode(self.guild.id))
+                self.warm_track = track
+            except Exception as e:
+                logger.warning(f"Failed to warm {track.title} in guild {self.guild.id}: {e}")
+
+        self.warm_task = asyncio.create_task(warm())
+
+    def take_warm(self, track: Track):
+        """Hand over the warmed source if it belongs to this track"""
+        if self.warm_track is not track:
+            self.drop_warm()
+            return None
+        source = self.warm_source
+        self.warm_track = self.warm_source = None
+        return source
+
+    def drop_warm(self):
+        if self.warm_source:
+            self.warm_source.cleanup()
+        self.warm_track = self.warm_source = None
+
+    def cancel(self, track: Track):
+        """Abandon work for a track that left the queue"""
+        task = self.tasks.pop(track, None)
+        if task:
+            task.cancel()
+        if self.warm_track is track:
+            self.drop_warm()
+
+    def stop(self):
+        """Cancel everything, e.g. on /stop or /leave"""
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        if self.warm_handle:
+            self.warm_handle.cancel()
+            self.warm_handle = None
+        if self.warm_task:
+            self.warm_task.cancel()
+            self.warm_task = None
+        self.drop_warm()
+
+class PlaybackController:
+    """Runs one guild's track transitions on the event loop.
+
+    discord.py calls a player's after= callback on its audio thread; that callback
+    only hands an event to this controller. Events are handled one at a time by a
+    task that holds the guild's playback lock, which /play also takes to start a
+    song, so a track ending, a skip and a /stop never interleave halfway through
+    choosing and starting the next song. Ends of plays that have since been
+    replaced are ignored, and /stop or /leave abandons a transition in progress.
+    """
+
+    def __init__(self, music: "Music", guild: discord.Guild):
+        self.music = music
+        self.guild = guild
+        self.loop = music.bot.loop
+        self.lock = asyncio.Lock()
+        self.events: Deque[tuple] = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.play_id = 0  # Bumped by every start; an end from an older play is stale
+        self.generation = 0  # Bumped by reset; transitions begun before it are dropped
+        self.advance_pending = False
+        self.awaiting_end = False  # The latest play's end hasn't been handled yet
+        self.retries: Dict[Track, int] = {}
+
+    def started(self) -> Callable:
+        """after= callback for a player that is about to start"""
+        self.play_id += 1
+        self.awaiting_end = True
+        play_id = self.play_id
+
+        def after(error):
+            # Audio thread: note the time and leave everything else to the event loop
+            self.loop.call_soon_threadsafe(self._post, ('ended', play_id, time.perf_counter(), error))
+        return after
+
+    def advance(self):
+        """Start the next queued song if nothing is playing.
+
+        Does nothing while the latest song's end is still on its way, so a song that
+        just broke off can be retried before the queue moves on.
+        """
+        if not self.advance_pending:
+            self.advance_pending = True
+            self._post(('advance', None, None, None))
+
+    def busy(self) -> bool:
+        """Whether a song change is waiting or under way, retry delays included"""
+        return self.task is not None
+
+    def _post(self, event):
+        self.events.append(event)
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self.events:
+                kind, play_id, ended_at, error = self.events.popleft()
+                try:
+                    if kind == 'advance':
+                        self.advance_pending = False
+                        if not self.awaiting_end:
+                            await self.play_next()
+                    elif play_id == self.play_id:
+                        self.awaiting_end = False
+                        await self._ended(ended_at, error)
+                except Exception as e:
+                    logger.error(f"Playback controller error in guild {self.guild.id}: {e}")
+        finally:
+            self.task = None
+
+    async def _ended(self, ended_at: float, error):
+        queue = self.music.get_queue(self.guild.id)
+        track = queue.current
+        if error:
+            logger.error(f"Player error in guild {self.guild.id}: {error}")
+            if track is not None and not queue.skipped and self._retry(track):
+                # Pick the song up where it broke off, with a freshly resolved stream
+                offset = queue.position()
+                track.stream_url = None
+                await asyncio.sleep(TRACK_RETRY_DELAY)
+                async with self.lock:
+                    if queue.current is track and self._idle():
+                        try:
+                            player = await self._source(track, offset)
+                        except Exception as e:
+                            logger.error(f"Retry of {track.title} in guild {self.guild.id} failed: {e}")
+                        else:
+                            if queue.current is track and self._idle():
+                                self.music._start_playing(self.guild, self.guild.voice_client, player, track, offset, ended_at=ended_at)
+                                return
+                            player.cleanup()
+        await self.play_next(ended_at)
+
+    def _retry(self, track: Track) -> bool:
+        attempts = self.retries.get(track, 0)
+        if attempts >= TRACK_RETRIES:
+            self.retries.pop(track, None)
+            track_retries.inc("gave_up")
+            return False
+        self.retries[track] = attempts + 1
+        track_retries.inc("retried")
+        return True
+
+    def _idle(self) -> bool:
+        vc = self.guild.voice_client
+        return isinstance(vc, discord.VoiceClient) and vc.is_connected() and not vc.is_playing() and not vc.is_paused()
+
+    async def _source(self, track: Track, offset: float = 0.0):
+        return await YTDLSource.from_track(track, loop=self.loop, mode=self.music.get_playback_mode(self.guild.id),
+                                           guild_id=self.guild.id, seek=offset)
+
+    async def play_next(self, ended_at: Optional[float] = None):
+        """Play the next song in the queue, spawning its audio source just in time.
+
+        ended_at is when the previous song finished, if this continues straight on from
+        it; only those starts count towards the track gap.
+        """
+        async with self.lock:
+            if not self._idle():
+                return
+            generation = self.generation
+            guild = self.guild
+            queue = self.music.get_queue(guild.id)
+            prefetcher = self.music.get_prefetcher(guild)
+            next_song = None
+            while generation == self.generation:
+                if next_song is None:
+                    next_song = queue.get_next()
+                    if not next_song:
+                        break
+                try:
+                    await prefetcher.ready(next_song)
+                    player = prefetcher.take_warm(next_song)
+                    if player is None:
+                        player = await self._source(next_song)
+                except Exception as e:
+                    if generation == self.generation and self._retry(next_song):
+                        logger.warning(f"Retrying {next_song.title} in guild {guild.id}: {e}")
+                        next_song.stream_url = None
+                        await asyncio.sleep(TRACK_RETRY_DELAY)
+                        continue
+                    logger.error(f"Skipping {next_song.title} in guild {guild.id}: {e}")
+                    # Don't let loop modes bring a broken track straight back
+                    queue.current = None
+                    next_song = None
+                    continue
+                if generation != self.generation or not self._idle():
+                    # /stop, /leave or a disconnect while we were resolving
+                    player.cleanup()
+                    if generation == self.generation:
+                        queue.push_front(next_song)
+                    return
+                self.retries.pop(next_song, None)
+                queue.current = next_song
+                self.music._start_playing(guild, guild.voice_client, player, next_song, ended_at=ended_at)
+                return
+            if generation == self.generation:
+                queue.current = None
+                self.music.now_playing.update(guild.id)
+
+    def reset(self):
+        """Abandon any transition in progress, e.g. on /stop or /leave"""
+        self.generation += 1
+        self.retries.clear()
+
+class IdleTracker:
+    """Leaves voice channels that have had no listeners for a while.
+
+    Driven by voice state events for the affected channel only, with at most one
+    pending disconnect per guild that is cancelled as soon as someone rejoins.
+    """
+
+    def __init__(self, music: "Music", timeout: float):
+        self.music = music
+        self.timeout = timeout
+        self.timers: Dict[int, asyncio.Task] = {}
+
+    def check(self, guild: discord.Guild):
+        vc = guild.voice_client
+        channel = getattr(vc, "channel", None)
+        if channel is None or any(not m.bot for m in channel.members):
+            self.cancel(guild.id)
+        elif guild.id not in self.timers:
+            self.timers[guild.id] = asyncio.create_task(self._disconnect_later(guild))
+
+    def cancel(self, guild_id: int):
+        timer = self.timers.pop(guild_id, None)
+        if timer and timer is not asyncio.current_task():
+            timer.cancel()
+
+    def cancel_all(self):
+        for guild_id in list(self.timers):
+            self.cancel(guild_id)
+
+    async def _disconnect_later(self, guild: discord.Guild):
+        try:
+            await asyncio.sleep(self.timeout)
+            vc = guild.voice_client
+            channel = getattr(vc, "channel", None)
+            if channel is None or any(not m.bot for m in channel.members):
+                return
+            logger.info(f"Leaving idle voice channel in guild {guild.id}")
+            await vc.disconnect(force=False)
+            self.music.reset_guild(guild.id)
+        finally:
+            if self.timers.get(guild.id) is asyncio.current_task():
+                del self.timers[guild.id]
+
+class LatencyStats:
+    """Rolling latency samples, in seconds"""
+
+    def __init__(self, window: int = 500):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, pct: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
 
-    def __getitem__(self, index):
-        return self.queue[index]
+    def summary(self) -> str:
+        return f"p50={self.percentile(50) * 1000:.0f}ms p95={self.percentile(95) * 1000:.0f}ms n={self.count}"
+
+class NowPlaying:
+    """One now-playing message per guild, edited in place.
+
+    Changes only mark the guild dirty; a per-guild task renders the latest state and
+    edits the message at most once per interval, so a burst of skips or a playlist
+    load costs a single REST call. Changes that leave what the message shows as it
+    was are dropped before that, and aren't counted as requested edits.
+    """
+
+    def __init__(self, music: "Music", interval: float):
+        self.music = music
+        self.interval = interval
+        self.messages: Dict[int, discord.PartialMessage] = {}
+        self.dirty = set()
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.last_edit: Dict[int, float] = {}
+        self.latest: Dict[int, tuple] = {}  # What the message should show, as of the last update
+        self.shown: Dict[int, tuple] = {}  # What it shows now
+        # requested counts the edits an uncoalesced updater would have made
+        self.stats = {'requested': 0, 'edited': 0, 'failed': 0}
+
+    def attach(self, guild_id: int, message):
+        """Adopt a freshly sent now-playing message; later updates edit it"""
+        if message is None:
+            return
+        self.messages[guild_id] = message.channel.get_partial_message(message.id)
+        self.last_edit[guild_id] = time.monotonic()
+        self.latest[guild_id] = self.shown[guild_id] = self.music.now_playing_state(guild_id)
+        self.dirty.discard(guild_id)
+
+    def update(self, guild_id: int):
+        if guild_id not in self.messages:
+            return
+        state = self.music.now_playing_state(guild_id)
+        if state == self.latest.get(guild_id):
+            return
+        self.latest[guild_id] = state
+        self.stats['requested'] += 1
+        self.dirty.add(guild_id)
+        if guild_id not in self.tasks:
+            self.tasks[guild_id] = asyncio.create_task(self._flush(guild_id))
+
+    async def _flush(self, guild_id: int):
+        try:
+            while guild_id in self.dirty:
+                delay = self.last_edit.get(guild_id, 0.0) + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                message = self.messages.get(guild_id)
+                if message is None or guild_id not in self.dirty:
+                    return
+                self.dirty.discard(guild_id)
+                state = self.music.now_playing_state(guild_id)
+                if state == self.shown.get(guild_id):
+                    continue  # Changed and changed back since the last edit
+                embed, view = self.music.now_playing_embed(guild_id)
+                self.last_edit[guild_id] = time.monotonic()
+                try:
+                    await message.edit(embed=embed, view=view)
+                    self.shown[guild_id] = state
+                    self.stats['edited'] += 1
+                except discord.HTTPException as e:
+                    self.stats['failed'] += 1
+                    logger.warning(f"Could not update now-playing message in guild {guild_id}: {e}")
+                    if isinstance(e, (discord.NotFound, discord.Forbidden)):
+                        self.forget(guild_id)
+                        return
+        finally:
+            if self.tasks.get(guild_id) is asyncio.current_task():
+                del self.tasks[guild_id]
+
+    def forget(self, guild_id: int):
+        self.messages.pop(guild_id, None)
+        self.dirty.discard(guild_id)
+        self.last_edit.pop(guild_id, None)
+        self.latest.pop(guild_id, None)
+        self.shown.pop(guild_id, None)
+
+    def saved(self) -> int:
+        """REST calls avoided by coalescing"""
+        return self.stats['requested'] - self.stats['edited'] - self.stats['failed']
+
+    def cancel_all(self):
+        for task in self.tasks.values():
+            task.cancel()
 
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.music_queues = {}  # Store queues per guild
-        self.leave_check.start()
+        self.playback_modes = {}  # Per-guild playback mode overrides
+        self.prefetchers = {}  # Per-guild lookahead resolvers
+        self.controllers: Dict[int, PlaybackController] = {}
+        self.guild_profiles: Dict[int, str] = {}  # Quality profile each guild's current song started with
+        self.cpu_sampler = CpuSampler()
+        self.track_gaps = LatencyStats()
+        self.playlist_loads = {}  # Guild ID -> token of the playlist currently being ingested
+        self.idle_tracker = IdleTracker(self, IDLE_DISCONNECT_SECONDS)
+        self.queue_store = QueueStore(os.path.join(DATA_DIR, "sessions.sqlite3"))
+        self.sessions_resumed = False
+        self.warm_task = None
+        self.search_index = SearchIndex(AUTOCOMPLETE_INDEX_SIZE)
+        self.now_playing = NowPlaying(self, NOW_PLAYING_INTERVAL)
+        self.quotas = Quotas(
+            play_rate=PLAY_RATE_PER_MINUTE, play_burst=PLAY_BURST, global_play_rate=GLOBAL_PLAY_RATE_PER_MINUTE,
+            max_queue=MAX_QUEUE_LENGTH, max_lookups=GUILD_LOOKUP_LIMIT, max_streams=MAX_VOICE_STREAMS,
+        )
+        # One persistent view serves every now-playing message
+        self.controls = MusicControls(self)
+        self.background_search = DebouncedSearch(self.search_for_autocomplete) if AUTOCOMPLETE_SEARCH_RESULTS > 0 else None
+        metrics.Gauge("musicbot_voice_clients", "Connected voice clients", callback=lambda: len(self.bot.voice_clients))
+        metrics.Gauge("musicbot_queued_tracks", "Tracks waiting across all queues", callback=lambda: sum(len(q) for q in self.music_queues.values()))
+        metrics.Gauge("musicbot_now_playing_updates", "Now-playing updates requested, edits made and failed", ("event",),
+                      callback=lambda: {(event,): count for event, count in self.now_playing.stats.items()})
+        metrics.Gauge("musicbot_now_playing_edits_saved", "REST calls avoided by coalescing now-playing updates", callback=self.now_playing.saved)
+        metrics.Gauge("musicbot_quality_level", "Quality profile new streams start with (0 is best)", callback=lambda: load_monitor.level)
+        metrics.Gauge("musicbot_host_cpu", "Host CPU use seen by the quality monitor", callback=lambda: load_monitor.cpu)
+        metrics.Gauge("musicbot_streams_by_quality", "Guilds by the quality profile of their current song", ("profile",),
+                      callback=lambda: {(p.name,): sum(1 for name in self.guild_profiles.values() if name == p.name) for p in PROFILES})
+        metrics.Gauge("musicbot_longest_queue", "Length of the longest guild queue", callback=lambda: max((len(q) for q in self.music_queues.values()), default=0))
 
     def get_queue(self, guild_id: int) -> MusicQueue:
         """Get or create music queue for a guild"""
         if guild_id not in self.music_queues:
-            self.music_queues[guild_id] = MusicQueue()
+            self.music_queues[guild_id] = MusicQueue(on_change=lambda: self._queue_changed(guild_id))
         return self.music_queues[guild_id]
 
+    def _queue_changed(self, guild_id: int):
+        self.queue_store.mark_queue(guild_id)
+        self.now_playing.update(guild_id)
+
+    def get_prefetcher(self, guild: discord.Guild) -> Prefetcher:
+        """Get or create the prefetcher for a guild"""
+        if guild.id not in self.prefetchers:
+            self.prefetchers[guild.id] = Prefetcher(self, guild)
+        return self.prefetchers[guild.id]
+
+    def get_controller(self, guild: discord.Guild) -> PlaybackController:
+        """Get or create the playback controller for a guild"""
+        if guild.id not in self.controllers:
+            self.controllers[guild.id] = PlaybackController(self, guild)
+        return self.controllers[guild.id]
+
+    def reset_guild(self, guild_id: int):
+        """Clear a guild's queue and drop any work prefetched for it"""
+        controller = self.controllers.get(guild_id)
+        if controller:
+            controller.reset()
+        queue = self.get_queue(guild_id)
+        queue.clear()
+        prefetcher = self.prefetchers.pop(guild_id, None)
+        if prefetcher:
+            prefetcher.stop()
+        self.playlist_loads.pop(guild_id, None)
+        self.guild_profiles.pop(guild_id, None)
+
+    def _start_playing(self, guild: discord.Guild, vc: discord.VoiceClient, player, track: Track, offset: float = 0.0,
+                       ended_at: Optional[float] = None):
+        """Hand a source to the voice client and start looking ahead.
+
+        ended_at is when the song before finished, for track changes made by the
+        controller; starts from /play or a resumed session aren't gaps.
+        """
+        profile = getattr(player, 'profile', load_monitor.profile)
+        if not player.is_opus() and discord.opus.is_loaded() and getattr(getattr(vc, 'encoder', None), 'profile', None) is not profile:
+            # discord.py encodes PCM sources on the audio thread with the voice client's encoder.
+            # Swap in a fresh one set up for this profile before that thread starts, rather than
+            # changing settings on an encoder a previous player's thread may still be using
+            vc.encoder = ProfileEncoder(profile)
+        vc.play(player, after=self.get_controller(guild).started())
+        self.guild_profiles[guild.id] = profile.name
+        self.get_queue(guild.id).mark_started(offset)
+        if ended_at is not None:
+            gap = time.perf_counter() - ended_at
+            self.track_gaps.add(gap)
+            track_gap_seconds.observe(gap)
+            logger.info(f"Track gap in guild {guild.id}: {gap * 1000:.0f}ms ({self.track_gaps.summary()})")
+        prefetcher = self.get_prefetcher(guild)
+        prefetcher.schedule()
+        if track.duration:
+            prefetcher.warm_after(track.duration - offset - PREFETCH_WARM_SECONDS)
+
+    def now_playing_state(self, guild_id: int) -> tuple:
+        """Everything the now-playing embed shows, so updates that change none of it can be skipped"""
+        queue = self.get_queue(guild_id)
+        if queue.current is None:
+            return ()
+        return (queue.current, queue.paused, queue.up_next(), len(queue) if len(queue) > 1 else None,
+                queue.loop_mode, queue.shuffle, self.guild_profiles.get(guild_id))
+
+    def now_playing_embed(self, guild_id: int):
+        """Embed and view for a guild's now-playing message, from its current state"""
+        queue = self.get_queue(guild_id)
+        track = queue.current
+        if track is None:
+            return self._make_embed("⏹️ Queue finished.", discord.Color.dark_grey()), None
+        embed = discord.Embed(
+            title="⏸️ Paused" if queue.paused else "🎵 Now Playing",
+            description=f"**{track.title}**\n🎤 Uploader: {track.uploader}",
+            color=discord.Color.blurple()
+        )
+        if track.duration and track.duration > 0:
+            embed.add_field(name="⏱️ Duration", value=track.format_duration(), inline=True)
+        up_next = queue.up_next()
+        next_song = up_next.title if up_next else "Nothing in queue"
+        embed.add_field(name="📅 Next Up", value=next_song, inline=True)
+        if len(queue) > 1:
+            embed.add_field(name="📜 In Queue", value=str(len(queue)), inline=True)
+        modes = []
+        if queue.loop_mode == "one":
+            modes.append("🔂 Looping song")
+        elif queue.loop_mode == "all":
+            modes.append("🔁 Looping queue")
+        if queue.shuffle:
+            modes.append("🔀 Shuffle")
+        if modes:
+            embed.add_field(name="⚙️ Mode", value=", ".join(modes), inline=True)
+        profile = self.guild_profiles.get(guild_id)
+        if profile and profile != PROFILES[0].name:
+            embed.add_field(name="📶 Quality", value=f"{profile} (bot under load)", inline=True)
+        if track.thumbnail:
+            embed.set_thumbnail(url=track.thumbnail)
+        if track.requester:
+            embed.set_footer(text=f"Requested by {track.requester}")
+        return embed, self.controls
+
+    def get_playback_mode(self, guild_id: int) -> str:
+        """Get the playback mode for a guild, falling back to the global default"""
+        return self.playback_modes.get(guild_id, PLAYBACK_MODE)
+
     @app_commands.command(name="play", description="🎶 Play music from a URL or search term")
     async def play(self, interaction: discord.Interaction, query: str):
+        guild = interaction.guild
+        if guild:
+            vc = guild.voice_client
+            try:
+                self.quotas.admit_play(
+                    guild.id,
+                    queued=len(self.get_queue(guild.id)),
+                    new_stream=not (isinstance(vc, discord.VoiceClient) and (vc.is_playing() or vc.is_paused())),
+                    streams=sum(1 for v in self.bot.voice_clients if isinstance(v, discord.VoiceClient) and v.is_playing()),
+                )
+            except QuotaExceeded as e:
+                # Answered straight away, before deferring or looking anything up
+                quota_rejections.inc(e.reason)
+                return await interaction.response.send_message(embed=self._make_embed(str(e), discord.Color.red()), ephemeral=True)
+        try:
+            await self._play(interaction, query)
+        finally:
+            if guild:
+                self.quotas.release_play(guild.id)
+
+    async def _play(self, interaction: discord.Interaction, query: str):
         await interaction.response.defer(thinking=True)
         user = interaction.user
         guild = interaction.guild
@@ -165,46 +1325,150 @@ class Music(commands.Cog):
         elif vc.channel != user.voice.channel:
             return await interaction.followup.send(embed=self._make_embed("❗ You must be in the same voice channel as the bot.", discord.Color.red()))
 
+        if is_playlist_url(query):
+            return await self._play_playlist(interaction, guild, query)
+
         try:
-            player = await YTDLSource.from_url(query, loop=self.bot.loop, stream=True)
+            data = await YTDLSource.extract_info(query, loop=self.bot.loop, guild_id=guild.id, fresh_stream=False)
         except Exception as e:
             return await interaction.followup.send(embed=self._make_embed(str(e), discord.Color.red()))
+        track = Track.from_data(data, requester=user.display_name)
+        self.search_index.add(track.webpage_url, track.title, uploader=track.uploader, duration=track.duration,
+                              query=None if is_url(query) else query, played=True)
 
-        vc = guild.voice_client if guild else None
-        queue = self.get_queue(guild.id) if guild else None
-        if vc and isinstance(vc, discord.VoiceClient) and (vc.is_playing() or vc.is_paused()):
-            if queue:
-                queue.add(player)
+        queue = self.get_queue(guild.id)
+        controller = self.get_controller(guild)
+        # Decide and start under the playback lock so a song ending right now can't start one too
+        async with controller.lock:
+            vc = guild.voice_client
+            playing = isinstance(vc, discord.VoiceClient) and (vc.is_playing() or vc.is_paused())
+            # A song that has just ended or is waiting to be retried keeps its turn, and
+            # so does everything queued behind it; the controller moves on when it's done
+            busy = playing or queue.current is not None or controller.busy()
+            if busy:
+                queue.add(track)
+                self.get_prefetcher(guild).schedule()
+                if not playing:
+                    controller.advance()
+            else:
+                if isinstance(vc, discord.VoiceClient):
+                    try:
+                        player = await YTDLSource.from_track(track, loop=self.bot.loop, mode=self.get_playback_mode(guild.id), guild_id=guild.id)
+                    except Exception as e:
+                        return await interaction.followup.send(embed=self._make_embed(str(e), discord.Color.red()))
+                    queue.current = track
+                    self._start_playing(guild, vc, player, track)
+                else:
+                    queue.current = track
+        if busy:
             embed = discord.Embed(
                 title="📝 Added to Queue", 
-                description=f"🎵 **{player.title}**\n🎤 Uploader: {player.uploader}", 
+                description=f"🎵 **{track.title}**\n🎤 Uploader: {track.uploader}", 
                 color=discord.Color.green()
             )
-            if player.duration and player.duration > 0:
-                embed.add_field(name="⏱️ Duration", value=player.format_duration(), inline=True)
-            embed.add_field(name="📍 Position in Queue", value=str(len(queue.queue) if queue else 0), inline=True)
-            if player.thumbnail:
-                embed.set_thumbnail(url=player.thumbnail)
+            if track.duration and track.duration > 0:
+                embed.add_field(name="⏱️ Duration", value=track.format_duration(), inline=True)
+            embed.add_field(name="📍 Position in Queue", value=str(len(queue)), inline=True)
+            if track.thumbnail:
+                embed.set_thumbnail(url=track.thumbnail)
             embed.set_footer(text=f"Requested by {interaction.user.display_name}", icon_url=interaction.user.display_avatar.url)
             await interaction.followup.send(embed=embed)
         else:
-            if vc and isinstance(vc, discord.VoiceClient) and player:
-                vc.play(player, after=lambda e: self.play_next_song(guild))
-            if queue:
-                queue.current = player
-            embed = discord.Embed(
-                title="🎵 Now Playing", 
-                description=f"**{player.title}**\n🎤 Uploader: {player.uploader}", 
-                color=discord.Color.blurple()
-            )
-            if player.duration and player.duration > 0:
-                embed.add_field(name="⏱️ Duration", value=player.format_duration(), inline=True)
-            next_song = queue.queue[0].title if queue and len(queue.queue) > 0 else "Nothing in queue"
-            embed.add_field(name="📅 Next Up", value=next_song, inline=True)
-            if player.thumbnail:
-                embed.set_thumbnail(url=player.thumbnail)
-            embed.set_footer(text=f"Requested by {interaction.user.display_name}", icon_url=interaction.user.display_avatar.url)
-            await interaction.followup.send(embed=embed, view=MusicControls(self, guild.id if guild else 0))
+            embed, view = self.now_playing_embed(guild.id)
+            message = await interaction.followup.send(embed=embed, view=view, wait=True)
+            self.now_playing.attach(guild.id, message)
+
+    @play.autocomplete('query')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+        """Suggest songs from the local index; unknown text is searched in the background for the next keystroke"""
+        if is_url(current):
+            return []
+        matches = self.search_index.search(current, limit=25)
+        if len(matches) < AUTOCOMPLETE_SEARCH_RESULTS and self.background_search is not None and not extraction_pool.backlog:
+            self.background_search.request(interaction.user.id, current)
+        choices = []
+        for entry in matches:
+            name = entry.title
+            if entry.duration:
+                name = f"{name} ({int(entry.duration) // 60}:{int(entry.duration) % 60:02d})"
+            if len(name) > 100:
+                name = name[:99] + "…"
+            if len(entry.url) <= 100:
+                choices.append(app_commands.Choice(name=name, value=entry.url))
+        return choices
+
+    async def search_for_autocomplete(self, text: str):
+        """Add the top search results for text to the autocomplete index"""
+        count = 0
+        async for entry in extraction_pool.iter_playlist(f"ytsearch{AUTOCOMPLETE_SEARCH_RESULTS}:{text}"):
+            track = Track.from_entry(entry)
+            if track.webpage_url:
+                self.search_index.add(track.webpage_url, track.title, uploader=track.uploader, duration=track.duration, query=text)
+            count += 1
+            if count >= AUTOCOMPLETE_SEARCH_RESULTS:
+                break
+
+    async def _play_playlist(self, interaction: discord.Interaction, guild: discord.Guild, url: str):
+        """Stream playlist entries into the queue, starting playback with the first one"""
+        queue = self.get_queue(guild.id)
+        prefetcher = self.get_prefetcher(guild)
+        controller = self.get_controller(guild)
+        room = self.quotas.queue_room(len(queue))
+        token = object()
+        self.playlist_loads[guild.id] = token
+        message = await interaction.followup.send(embed=self._make_embed("📃 Loading playlist...", discord.Color.blurple()), wait=True)
+
+        added = 0
+        title = None
+        last_progress = time.monotonic()
+        error = None
+        try:
+            async for entry in extraction_pool.iter_playlist(url):
+                if self.playlist_loads.get(guild.id) is not token:
+                    break  # /stop, /leave or another playlist took over
+                if added >= PLAYLIST_LIMIT:
+                    break
+                if room is not None and added >= room:
+                    quota_rejections.inc("queue_full")
+                    break
+                title = title or entry.get('playlist_title')
+                queue.add(Track.from_entry(entry, requester=interaction.user.display_name))
+                added += 1
+
+                vc = guild.voice_client
+                idle = isinstance(vc, discord.VoiceClient) and not vc.is_playing() and not vc.is_paused()
+                if idle and queue.current is None:
+                    controller.advance()
+                if time.monotonic() - last_progress >= PLAYLIST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    prefetcher.schedule()
+                    try:
+                        await message.edit(embed=self._playlist_embed(title, added, done=False))
+                    except discord.HTTPException:
+                        pass
+        except Exception as e:
+            error = e
+            logger.error(f"Playlist ingestion failed in guild {guild.id}: {e}")
+        finally:
+            if self.playlist_loads.get(guild.id) is token:
+                del self.playlist_loads[guild.id]
+
+        if added == 0:
+            text = f"❌ Error: {error}" if error else "❌ No playable entries found."
+            return await message.edit(embed=self._make_embed(text, discord.Color.red()))
+        prefetcher.schedule()
+        embed = self._playlist_embed(title, added, done=True)
+        embed.set_footer(text=f"Requested by {interaction.user.display_name}", icon_url=interaction.user.display_avatar.url)
+        await message.edit(embed=embed)
+
+    def _playlist_embed(self, title, added, *, done):
+        embed = discord.Embed(
+            title="📃 Playlist Added" if done else "📃 Loading Playlist...",
+            description=f"**{title or 'Playlist'}**",
+            color=discord.Color.green() if done else discord.Color.blurple()
+        )
+        embed.add_field(name="🎵 Songs", value=str(added), inline=True)
+        return embed
 
     @app_commands.command(name="skip", description="⏭️ Skip the current song")
     async def skip(self, interaction: discord.Interaction):
@@ -214,6 +1478,7 @@ class Music(commands.Cog):
             return await interaction.response.send_message(embed=self._make_embed("❗ Not connected to a voice channel.", discord.Color.red()))
         if not vc.is_playing():
             return await interaction.response.send_message(embed=self._make_embed("❗ No music is currently playing.", discord.Color.red()))
+        self.get_queue(guild.id).skipped = True
         vc.stop()
         await interaction.response.send_message(embed=self._make_embed("⏭️ Skipped the current song!", discord.Color.orange()))
 
@@ -224,16 +1489,16 @@ class Music(commands.Cog):
         if not vc or not isinstance(vc, discord.VoiceClient):
             return await interaction.response.send_message(embed=self._make_embed("❗ Not connected to a voice channel.", discord.Color.red()))
         vc.stop()
-        queue = self.get_queue(guild.id) if guild else None
-        if queue:
-            queue.clear()
+        if guild:
+            self.reset_guild(guild.id)
         await interaction.response.send_message(embed=self._make_embed("⏹️ Stopped music and cleared the queue!", discord.Color.red()))
 
     @app_commands.command(name="queue", description="📜 Show the current queue")
-    async def show_queue(self, interaction: discord.Interaction):
+    @app_commands.describe(page="Page of the queue to show")
+    async def show_queue(self, interaction: discord.Interaction, page: int = 1):
         guild = interaction.guild
         queue = self.get_queue(guild.id) if guild else None
-        if not queue or (not queue and not queue.current):
+        if queue is None or (not len(queue) and not queue.current):
             return await interaction.response.send_message(embed=self._make_embed("📭 The queue is empty and nothing is playing.", discord.Color.light_grey()))
         embed = discord.Embed(title="📜 Music Queue", color=discord.Color.green())
         if queue.current:
@@ -242,17 +1507,26 @@ class Music(commands.Cog):
                 value=f"**{queue.current.title}**\n🎤 {queue.current.uploader}\n⏱️ {queue.current.format_duration()}", 
                 inline=False
             )
+        pages = queue.page_count()
+        page = min(max(page, 1), pages)
         if queue:
             queue_list = []
-            for i, song in enumerate(queue.queue[:10]):
+            first = (page - 1) * QUEUE_PAGE_SIZE
+            for i, song in enumerate(queue.page(page), start=first + 1):
                 duration = song.format_duration()
-                queue_list.append(f"{i+1}. **{song.title}** - {duration}")
-            if len(queue.queue) > 10:
-                queue_list.append(f"... and {len(queue.queue) - 10} more songs")
+                queue_list.append(f"{i}. **{song.title}** - {duration}")
+            remaining = len(queue) - first - len(queue_list)
+            if remaining > 0:
+                queue_list.append(f"... and {remaining} more songs")
             embed.add_field(name="📅 Up Next", value="\n".join(queue_list), inline=False)
         else:
             embed.add_field(name="📅 Up Next", value="Nothing in queue", inline=False)
-        embed.set_footer(text=f"Total songs in queue: {len(queue.queue) if queue else 0}")
+        modes = [f"🔁 Loop: {queue.loop_mode}"]
+        if queue.shuffle:
+            modes.append("🔀 Shuffle on")
+        if queue.current and guild.id in self.guild_profiles:
+            modes.append(f"📶 Quality: {self.guild_profiles[guild.id]}")
+        embed.set_footer(text=f"Total songs in queue: {len(queue)} | Page {page}/{pages} | " + " | ".join(modes))
         await interaction.response.send_message(embed=embed)
 
     @app_commands.command(name="pause", description="⏸️ Pause the current song")
@@ -262,6 +1536,7 @@ class Music(commands.Cog):
         if not vc or not isinstance(vc, discord.VoiceClient) or not vc.is_playing():
             return await interaction.response.send_message(embed=self._make_embed("❗ No music is currently playing.", discord.Color.red()))
         vc.pause()
+        self.get_queue(guild.id).mark_paused()
         await interaction.response.send_message(embed=self._make_embed("⏸️ Music paused!", discord.Color.orange()))
 
     @app_commands.command(name="resume", description="▶️ Resume the paused song")
@@ -271,6 +1546,7 @@ class Music(commands.Cog):
         if not vc or not isinstance(vc, discord.VoiceClient) or not vc.is_paused():
             return await interaction.response.send_message(embed=self._make_embed("❗ Music is not paused.", discord.Color.red()))
         vc.resume()
+        self.get_queue(guild.id).mark_resumed()
         await interaction.response.send_message(embed=self._make_embed("▶️ Music resumed!", discord.Color.green()))
 
     @app_commands.command(name="leave", description="👋 Disconnect from voice channel")
@@ -280,35 +1556,74 @@ class Music(commands.Cog):
         if not vc or not isinstance(vc, discord.VoiceClient):
             return await interaction.response.send_message(embed=self._make_embed("❗ Not connected to a voice channel.", discord.Color.red()))
         await vc.disconnect(force=False)
-        queue = self.get_queue(guild.id) if guild else None
-        if queue:
-            queue.clear()
+        if guild:
+            self.reset_guild(guild.id)
         await interaction.response.send_message(embed=self._make_embed("👋 Disconnected from voice channel and cleared queue!", discord.Color.orange()))
 
     @app_commands.command(name="remove", description="🗑️ Remove a song from queue")
     async def remove(self, interaction: discord.Interaction, position: int):
         guild = interaction.guild
         queue = self.get_queue(guild.id) if guild else None
-        if not queue:
+        if queue is None:
             return await interaction.response.send_message(embed=self._make_embed("❗ No queue found.", discord.Color.red()))
-        if position < 1 or position > len(queue.queue):
+        if position < 1 or position > len(queue):
             return await interaction.response.send_message(embed=self._make_embed("❗ Invalid position in queue.", discord.Color.red()))
         removed_song = queue.remove(position - 1)
         if removed_song:
+            prefetcher = self.get_prefetcher(guild)
+            prefetcher.cancel(removed_song)
+            prefetcher.schedule()
             await interaction.response.send_message(embed=self._make_embed(f"🗑️ Removed **{removed_song.title}** from queue!", discord.Color.green()))
         else:
             await interaction.response.send_message(embed=self._make_embed("❗ Failed to remove song from queue.", discord.Color.red()))
 
     @app_commands.command(name="loop", description="🔁 Toggle loop mode")
-    async def loop(self, interaction: discord.Interaction):
+    @app_commands.describe(mode="Repeat the current song or the whole queue (toggles whole queue if omitted)")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="Off", value="off"),
+        app_commands.Choice(name="Current song", value="one"),
+        app_commands.Choice(name="Whole queue", value="all"),
+    ])
+    async def loop(self, interaction: discord.Interaction, mode: Optional[app_commands.Choice[str]] = None):
         guild = interaction.guild
         queue = self.get_queue(guild.id) if guild else None
-        if not queue:
+        if queue is None:
             return await interaction.response.send_message(embed=self._make_embed("❗ No queue found.", discord.Color.red()))
-        queue.loop = not queue.loop
-        status = "enabled" if queue.loop else "disabled"
+        if mode is None:
+            queue.loop_mode = "off" if queue.loop_mode != "off" else "all"
+        else:
+            queue.loop_mode = mode.value
+        queue.touch()
+        status = {"off": "disabled", "one": "enabled for the current song", "all": "enabled for the whole queue"}[queue.loop_mode]
         await interaction.response.send_message(embed=self._make_embed(f"🔁 Loop mode {status}!", discord.Color.green()))
 
+    @app_commands.command(name="shuffle", description="🔀 Toggle shuffle mode")
+    async def shuffle(self, interaction: discord.Interaction):
+        guild = interaction.guild
+        queue = self.get_queue(guild.id) if guild else None
+        if queue is None:
+            return await interaction.response.send_message(embed=self._make_embed("❗ No queue found.", discord.Color.red()))
+        queue.shuffle = not queue.shuffle
+        queue.touch()
+        status = "enabled" if queue.shuffle else "disabled"
+        # Prefetched tracks may no longer be next
+        self.get_prefetcher(guild).schedule()
+        await interaction.response.send_message(embed=self._make_embed(f"🔀 Shuffle mode {status}!", discord.Color.green()))
+
+    @app_commands.command(name="mode", description="🎚️ Choose how audio is processed for this server")
+    @app_commands.describe(mode="pcm: in-process volume control, opus: low-CPU passthrough")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="PCM (volume control)", value="pcm"),
+        app_commands.Choice(name="Opus passthrough (low CPU)", value="opus"),
+    ])
+    @app_commands.default_permissions(manage_guild=True)
+    async def mode(self, interaction: discord.Interaction, mode: app_commands.Choice[str]):
+        guild = interaction.guild
+        if not guild:
+            return await interaction.response.send_message(embed=self._make_embed("❗ This command can only be used in a server.", discord.Color.red()))
+        self.playback_modes[guild.id] = mode.value
+        await interaction.response.send_message(embed=self._make_embed(f"🎚️ Playback mode set to **{mode.name}**. Applies from the next song.", discord.Color.green()))
+
     @app_commands.command(name="help", description="ℹ️ Show help information")
     async def help(self, interaction: discord.Interaction):
         embed = discord.Embed(title="📖 Music Bot Commands", color=discord.Color.teal())
@@ -317,58 +1632,199 @@ class Music(commands.Cog):
         embed.add_field(name="/stop", value="Stop music and clear queue", inline=False)
         embed.add_field(name="/pause", value="Pause the current song", inline=False)
         embed.add_field(name="/resume", value="Resume paused music", inline=False)
-        embed.add_field(name="/queue", value="View the current queue", inline=False)
+        embed.add_field(name="/queue [page]", value="View the current queue", inline=False)
         embed.add_field(name="/remove [position]", value="Remove a song from queue", inline=False)
-        embed.add_field(name="/loop", value="Toggle loop mode", inline=False)
+        embed.add_field(name="/loop [mode]", value="Loop the current song or the whole queue", inline=False)
+        embed.add_field(name="/shuffle", value="Toggle shuffle mode", inline=False)
         embed.add_field(name="/leave", value="Disconnect from voice channel", inline=False)
+        embed.add_field(name="/mode [pcm/opus]", value="Choose audio processing mode", inline=False)
         embed.set_footer(text="Music Bot | Use these commands to control music playback")
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
-    def play_next_song(self, guild):
-        """Play next song in queue"""
-        queue = self.get_queue(guild.id) if guild else None
-        if queue and queue.loop and queue.current:
-            queue.add(queue.current)
-        if queue and len(queue.queue) > 0:
-            next_song = queue.get_next()
-            vc = guild.voice_client if guild else None
-            if vc and isinstance(vc, discord.VoiceClient) and next_song:
-                vc.play(next_song, after=lambda e: self.play_next_song(guild))
-                queue.current = next_song
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras['started_at'] = time.perf_counter()
+        return True
+
+    def _record_command(self, interaction: discord.Interaction, outcome: str):
+        started = interaction.extras.get('started_at')
+        if started is not None and interaction.command is not None:
+            command_seconds.observe(time.perf_counter() - started, interaction.command.name, outcome)
+
+    @commands.Cog.listener()
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        self._record_command(interaction, "ok")
+
+    async def cog_app_command_error(self, interaction: discord.Interaction, error):
+        # The tree's own handler still logs the error
+        self._record_command(interaction, "error")
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Re-check idleness of the one channel this event touched"""
+        guild = member.guild
+        if self.bot.user and member.id == self.bot.user.id:
+            if after.channel is None:
+                # Disconnected, possibly kicked by a moderator
+                self.idle_tracker.cancel(guild.id)
+                self.reset_guild(guild.id)
+            else:
+                self.idle_tracker.check(guild)
+            return
+        if member.bot or before.channel == after.channel:
+            return
+        vc = guild.voice_client
+        channel = getattr(vc, "channel", None)
+        if channel is not None and channel in (before.channel, after.channel):
+            self.idle_tracker.check(guild)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.sessions_resumed:
+            self.sessions_resumed = True
+            # Load yt-dlp in the workers now rather than on the first /play
+            self.warm_task = asyncio.create_task(self.warm_extraction())
+            self.queue_store.start(self.snapshot_session)
+            self.save_positions.start()
+            self.check_load.start()
+            await self.resume_sessions()
+            mark_startup("sessions resumed")
+
+    async def warm_extraction(self):
+        try:
+            await extraction_pool.warm_up()
+        except Exception as e:
+            logger.warning(f"yt-dlp warm-up failed: {e}")
         else:
-            if queue:
-                queue.current = None
+            mark_startup("yt-dlp loaded")
 
-    @tasks.loop(minutes=2.0)
-    async def leave_check(self):
-        """Check and leave voice channel if no one is listening"""
-        for vc in list(self.bot.voice_clients):
-            channel = getattr(vc, "channel", None)
-            if not channel or not isinstance(channel, discord.VoiceChannel):
+    @tasks.loop(seconds=POSITION_SAVE_INTERVAL)
+    async def save_positions(self):
+        """Keep saved playback positions fresh in case the process dies without warning"""
+        for guild_id, queue in self.music_queues.items():
+            if queue.current and not queue.paused:
+                self.queue_store.mark_position(guild_id)
+
+    @tasks.loop(seconds=QUALITY_CHECK_INTERVAL)
+    async def check_load(self):
+        """Pick the quality profile for streams starting from now on"""
+        streams = sum(1 for vc in self.bot.voice_clients if isinstance(vc, discord.VoiceClient) and vc.is_playing())
+        load_monitor.update(self.cpu_sampler.sample(), streams)
+
+    def snapshot_session(self, guild_id: int, full: bool):
+        """Saved form of a guild's session, or None if it has nothing worth resuming"""
+        queue = self.music_queues.get(guild_id)
+        guild = self.bot.get_guild(guild_id)
+        channel = getattr(guild.voice_client, "channel", None) if guild else None
+        if queue is None or channel is None or (queue.current is None and not queue):
+            return None
+        state = {
+            'channel_id': channel.id,
+            'current': queue.current.to_state() if queue.current else None,
+            'position': queue.position(),
+            'paused': queue.paused,
+        }
+        if full:
+            state['queue'] = {
+                'tracks': [track.to_state() for track in queue],
+                'loop_mode': queue.loop_mode,
+                'shuffle': queue.shuffle,
+            }
+        return state
+
+    async def resume_sessions(self):
+        """Reconnect and pick up where each saved session left off"""
+        try:
+            sessions = await self.queue_store.load_all()
+        except Exception as e:
+            logger.error(f"Failed to load saved queues: {e}")
+            return
+        resumes = []
+        for guild_id, state in sessions.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                if SHARD_IDS is None:
+                    # This process runs every shard, so the bot has left that server
+                    self.queue_store.mark_queue(guild_id)
+                # Otherwise it may belong to another shard cluster
                 continue
-            if not vc.is_playing() and not vc.is_paused():
-                members = [member for member in channel.members if not member.bot]
-                if len(members) == 0:
-                    await vc.disconnect(force=False)
-                    queue = self.get_queue(vc.guild.id) if hasattr(vc, "guild") and vc.guild else None
-                    if queue:
-                        queue.clear()
-
-    @leave_check.before_loop
-    async def before_leave_check(self):
-        await self.bot.wait_until_ready()
+            resumes.append(self._resume_session(guild, state))
+        if not resumes:
+            return
+        results = await asyncio.gather(*resumes, return_exceptions=True)
+        resumed = [r for r in results if isinstance(r, float)]
+        for r in results:
+            if isinstance(r, Exception):
+                logger.error(f"Failed to resume session: {r}")
+        if resumed:
+            logger.info(
+                f"Resumed {len(resumed)} of {len(resumes)} session(s); restart-to-first-audio "
+                f"{min(resumed):.1f}s, all resumed after {max(resumed):.1f}s"
+            )
+
+    async def _resume_session(self, guild: discord.Guild, state) -> Optional[float]:
+        """Restore one guild; returns seconds since process start when audio began"""
+        queue = self.get_queue(guild.id)
+        channel = guild.get_channel(state['channel_id'])
+        if not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)) or not any(not m.bot for m in channel.members):
+            # Nobody is listening any more; forget the session
+            self.queue_store.mark_queue(guild.id)
+            return None
+
+        saved = state['queue']
+        queue.extend(Track.from_state(t) for t in saved['tracks'])
+        queue.loop_mode = saved['loop_mode'] if saved['loop_mode'] in LOOP_MODES else "off"
+        queue.shuffle = saved['shuffle']
+        vc = guild.voice_client or await channel.connect()
+        controller = self.get_controller(guild)
+        player = None
+        if state['current']:
+            track = Track.from_state(state['current'])
+            offset = state['position']
+            if track.duration and offset >= track.duration:
+                offset = 0.0
+            async with controller.lock:
+                try:
+                    player = await YTDLSource.from_track(track, loop=self.bot.loop, mode=self.get_playback_mode(guild.id), guild_id=guild.id, seek=offset)
+                except Exception as e:
+                    logger.error(f"Could not resume {track.title} in guild {guild.id}: {e}")
+                if player is not None:
+                    queue.current = track
+                    self._start_playing(guild, vc, player, track, offset)
+                    if state['paused']:
+                        vc.pause()
+                        queue.mark_paused()
+        if player is None:
+            await controller.play_next()
+        self.idle_tracker.check(guild)
+        return time.perf_counter() - PROCESS_STARTED
+
+    async def cog_load(self):
+        # Buttons on now-playing messages keep working across restarts
+        self.bot.add_view(self.controls)
+
+    async def cog_unload(self):
+        self.idle_tracker.cancel_all()
+        self.now_playing.cancel_all()
+        if self.background_search is not None:
+            self.background_search.cancel_all()
+        self.save_positions.cancel()
+        self.check_load.cancel()
+        for guild_id, queue in self.music_queues.items():
+            if queue.current:
+                self.queue_store.mark_position(guild_id)
+        await self.queue_store.close(self.snapshot_session)
 
     def _make_embed(self, text, color):
         return discord.Embed(description=text, color=color)
 
 class MusicControls(discord.ui.View):
-    def __init__(self, music: Music, guild_id: int):
-        super().__init__(timeout=300)  # 5 minutes timeout
+    """Buttons shared by every now-playing message; acts on whichever guild they're clicked in"""
+
+    def __init__(self, music: Music):
+        super().__init__(timeout=None)
         self.music = music
-        self.guild_id = guild_id
-        self.message = None
 
-    @discord.ui.button(label="⏸️ Pause", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="⏸️ Pause", style=discord.ButtonStyle.primary, custom_id="music:pause")
     async def pause(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild = interaction.guild
         vc = guild.voice_client if guild else None
@@ -376,9 +1832,10 @@ class MusicControls(discord.ui.View):
             return await interaction.response.send_message("❗ No music is currently playing.", ephemeral=True)
         
         vc.pause()
+        self.music.get_queue(guild.id).mark_paused()
         await interaction.response.send_message("⏸️ Music paused!", ephemeral=True)
 
-    @discord.ui.button(label="▶️ Resume", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="▶️ Resume", style=discord.ButtonStyle.success, custom_id="music:resume")
     async def resume(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild = interaction.guild
         vc = guild.voice_client if guild else None
@@ -386,19 +1843,21 @@ class MusicControls(discord.ui.View):
             return await interaction.response.send_message("❗ Music is not paused.", ephemeral=True)
         
         vc.resume()
+        self.music.get_queue(guild.id).mark_resumed()
         await interaction.response.send_message("▶️ Music resumed!", ephemeral=True)
 
-    @discord.ui.button(label="⏭️ Skip", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="⏭️ Skip", style=discord.ButtonStyle.secondary, custom_id="music:skip")
     async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild = interaction.guild
         vc = guild.voice_client if guild else None
         if not vc or not isinstance(vc, discord.VoiceClient) or not vc.is_playing():
             return await interaction.response.send_message("❗ No music is currently playing.", ephemeral=True)
         
+        self.music.get_queue(guild.id).skipped = True
         vc.stop()
         await interaction.response.send_message("⏭️ Skipped the current song!", ephemeral=True)
 
-    @discord.ui.button(label="👋 Leave", style=discord.ButtonStyle.danger)
+    @discord.ui.button(label="👋 Leave", style=discord.ButtonStyle.danger, custom_id="music:leave")
     async def leave(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild = interaction.guild
         vc = guild.voice_client if guild else None
@@ -406,62 +1865,110 @@ class MusicControls(discord.ui.View):
             return await interaction.response.send_message("❗ Not connected to a voice channel.", ephemeral=True)
         
         await vc.disconnect(force=False)
-        queue = self.music.get_queue(self.guild_id) if self.guild_id else None
-        if queue:
-            queue.clear()
+        self.music.reset_guild(guild.id)
         await interaction.response.send_message("👋 Disconnected and cleared queue!", ephemeral=True)
 
-    async def on_timeout(self):
-        # Disable buttons when timeout
-        for item in self.children:
-            if hasattr(item, 'disabled'):
-                try:
-                    item.disabled = True
-                except Exception:
-                    pass
-        if self.message:
-            try:
-                await self.message.edit(view=self)
-            except Exception:
-                pass
-
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+def parse_shard_ids(value: Optional[str]) -> Optional[List[int]]:
+    """Parse SHARD_IDS such as "0,1,2" or "4-7" """
+    if not value:
+        return None
+    ids = []
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-", 1)
+            ids.extend(range(int(first), int(last) + 1))
+        elif part:
+            ids.append(int(part))
+    return ids
+
+# Sharding: SHARD_COUNT/SHARD_IDS are set by launcher.py for each cluster process,
+# AUTO_SHARD=1 lets a single process run every shard Discord recommends
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS"))
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", "300"))
+
+if SHARD_COUNT or SHARD_IDS or os.getenv("AUTO_SHARD") == "1":
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+@tasks.loop(seconds=SHARD_STATS_INTERVAL)
+async def log_shard_stats():
+    """Log latency and guild count per shard, for sizing clusters"""
+    if not isinstance(bot, commands.AutoShardedBot):
+        logger.info(f"Cluster {CLUSTER_ID}: latency {bot.latency * 1000:.0f}ms, {len(bot.guilds)} guild(s), {len(bot.voice_clients)} voice connection(s)")
+        return
+    guilds_per_shard = {}
+    voice_per_shard = {}
+    for guild in bot.guilds:
+        guilds_per_shard[guild.shard_id] = guilds_per_shard.get(guild.shard_id, 0) + 1
+        if guild.voice_client:
+            voice_per_shard[guild.shard_id] = voice_per_shard.get(guild.shard_id, 0) + 1
+    for shard_id, latency in bot.latencies:
+        logger.info(
+            f"Cluster {CLUSTER_ID} shard {shard_id}: latency {latency * 1000:.0f}ms, "
+            f"{guilds_per_shard.get(shard_id, 0)} guild(s), {voice_per_shard.get(shard_id, 0)} voice connection(s)"
+        )
+
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f"Cluster {CLUSTER_ID} shard {shard_id} ready")
+
+# Hash of the last command tree pushed to Discord, so restarts only sync when commands change
+COMMAND_HASH_FILE = os.path.join(DATA_DIR, "command_tree.sha256")
+
+def command_tree_hash() -> str:
+    commands_data = sorted((command.to_dict() for command in bot.tree.get_commands()), key=lambda c: (c.get('type', 1), c['name']))
+    payload = json.dumps({'application_id': bot.application_id, 'commands': commands_data}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def sync_commands():
+    """Sync the command tree only if it differs from what was last synced"""
+    digest = command_tree_hash()
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            saved = f.read().strip()
+    except OSError:
+        saved = None
+    if saved == digest and os.getenv("FORCE_COMMAND_SYNC") != "1":
+        print("✅ Commands unchanged, skipping sync")
+        return
+    synced = await bot.tree.sync()
+    print(f"✅ Synced {len(synced)} command(s)")
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(COMMAND_HASH_FILE, "w") as f:
+            f.write(digest)
+    except OSError as e:
+        logger.warning(f"Could not save command tree hash: {e}")
 
 @bot.event
 async def on_ready():
+    mark_startup("gateway ready")
     try:
-        synced = await bot.tree.sync()
         if bot.user:
             print(f"✅ Logged in as {bot.user.name}")
             print(f"🆔 Bot ID: {bot.user.id}")
             logger.info(f"Bot started successfully: {bot.user.name}")
-        print(f"✅ Synced {len(synced)} command(s)")
+        # Commands are global, so only one cluster needs to sync them, once per process
+        if CLUSTER_ID == 0 and "commands synced" not in startup_phases:
+            await sync_commands()
+            mark_startup("commands synced")
         print(f"📊 Connected to {len(bot.guilds)} guild(s)")
+        if bot.shard_count:
+            print(f"🧩 Shards {bot.shard_ids or list(range(bot.shard_count))} of {bot.shard_count}")
     except Exception as e:
         print(f"❌ Failed to sync commands: {e}")
         logger.error(f"Failed to sync commands: {e}")
-
-@bot.event
-async def on_voice_state_update(member, before, after):
-    """Handle voice state updates"""
-    if member.bot:
-        return
-    
-    # If bot is in voice channel and no other members
-    for vc in bot.voice_clients:
-        channel = getattr(vc, "channel", None)
-        if not channel or not isinstance(channel, discord.VoiceChannel):
-            continue
-        if len([m for m in channel.members if not m.bot]) == 0:
-            # Wait 30 seconds then disconnect if still no one
-            await asyncio.sleep(30)
-            if len([m for m in channel.members if not m.bot]) == 0:
-                await vc.disconnect(force=False)
+    if not log_shard_stats.is_running():
+        log_shard_stats.start()
 
 @bot.event
 async def on_command_error(ctx, error):
@@ -473,12 +1980,44 @@ async def on_command_error(ctx, error):
     await ctx.send(f"❌ An error occurred: {str(error)}")
 
 async def main():
-    async with bot:
-        await bot.add_cog(Music(bot))
-        if TOKEN and isinstance(TOKEN, str):
-            await bot.start(TOKEN)
+    if hasattr(signal, "SIGTERM"):
+        try:
+            # Railway and Docker stop containers with SIGTERM; shut down cleanly so queues are saved
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        except NotImplementedError:
+            pass
+    metrics_runner = lag_task = None
+    try:
+        mark_startup("modules imported")
+        async with bot:
+            await bot.add_cog(Music(bot))
+            if METRICS_PORT:
+                try:
+                    metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+                    lag_task = asyncio.create_task(metrics.measure_loop_lag(loop_lag, loop_lag_seconds))
+                except OSError as e:
+                    # Metrics are optional; a taken port shouldn't keep the shards offline
+                    logger.error(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}: {e}")
+            if TOKEN and isinstance(TOKEN, str):
+                await bot.login(TOKEN)
+                mark_startup("logged in")
+                await bot.connect()
+    finally:
+        if lag_task is not None:
+            lag_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        extraction_pool.shutdown()
+        metadata_cache.close()
+        if audio_cache is not None:
+            audio_cache.close()
 
 if __name__ == "__main__":
+    if not TOKEN:
+        logger.error("DISCORD_TOKEN not found in environment variables")
+        print("❌ DISCORD_TOKEN not found in environment variables")
+        print("Please set DISCORD_TOKEN in Railway Variables")
+        exit(1)
     try:
         print("🚀 Starting Discord Music Bot...")
         print(f"📝 Token loaded: {'Yes' if TOKEN else 'No'}")
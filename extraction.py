@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ExtractionError(Exception):
+    """yt-dlp failed; carries only the message so it survives pickling from worker processes"""
+
+class ExtractionBusy(Exception):
+    """The admission queue is full"""
+
+# Each worker thread (or process) owns its YoutubeDL, as instances aren't safe to share
+_local = threading.local()
+
+def _init_worker(options, ytdl_class=None):
+    if ytdl_class is None:
+        import yt_dlp
+        ytdl_class = yt_dlp.YoutubeDL
+    _local.ytdl = ytdl_class(options)
+
+def _init_flat_worker(options, ytdl_class=None):
+    if ytdl_class is None:
+        import yt_dlp
+        ytdl_class = yt_dlp.YoutubeDL
+    _local.ytdl = ytdl_class({**options, 'extract_flat': 'in_playlist', 'noplaylist': False})
+
+def _iter_flat(url, push, stop, done):
+    """Walk a playlist page by page, pushing each entry as soon as yt-dlp yields it"""
+    ytdl = _local.ytdl
+    try:
+        info = ytdl.extract_info(url, download=False, process=False)
+        if info and info.get('_type') in ('playlist', 'multi_video'):
+            for entry in info.get('entries') or ():
+                if stop.is_set():
+                    break
+                if entry:
+                    push({**entry, 'playlist_title': info.get('title')})
+        elif info:
+            push(info)
+    except Exception as e:
+        push(ExtractionError(str(e)))
+    finally:
+        push(done)
+
+def _extract(url, download):
+    ytdl = _local.ytdl
+    try:
+        info = ytdl.extract_info(url, download=download)
+    except Exception as e:
+        raise ExtractionError(str(e)) from None
+    if info is None:
+        return None
+    return ytdl.sanitize_info(info)
+
+def _warm():
+    """No-op job; running it means the worker has loaded yt-dlp"""
+    return True
+
+class _Job:
+    __slots__ = ('key', 'guild_id', 'future', 'waiters', 'started')
+
+    def __init__(self, key, guild_id, future):
+        self.key = key
+        self.guild_id = guild_id
+        self.future = future
+        self.waiters = 0
+        self.started = False
+
+class ExtractionPool:
+    """Bounded yt-dlp worker pool with per-guild fairness and in-flight deduplication.
+
+    Jobs wait in one queue per guild and are dispatched round-robin, so a guild queueing
+    fifty songs can't starve everyone else. Identical requests share a single extraction.
+    A job that is still queued when its last waiter gives up (e.g. a timeout) is dropped;
+    one already running in a worker finishes, but its result is discarded.
+    """
+
+    def __init__(self, options, *, workers: int = 4, backend: str = "thread", max_pending: int = 64,
+                 playlist_workers: int = 2, ytdl_class=None):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown extraction backend: {backend}")
+        self.options = options
+        self.workers = workers
+        self.backend = backend
+        self.max_pending = max_pending
+        self.ytdl_class = ytdl_class
+        self.executor = None
+        self.playlist_workers = playlist_workers
+        self.flat_executor = None
+        self.running = 0
+        self.pending: "OrderedDict[int, Deque[_Job]]" = OrderedDict()
+        self.pending_count = 0
+        self.inflight: Dict[Tuple[str, bool], _Job] = {}
+        self.deduplicated = 0
+
+    @property
+    def backlog(self) -> int:
+        """Jobs waiting for a free worker"""
+        return self.pending_count
+
+    def _get_executor(self):
+        if self.executor is None:
+            if self.backend == "process":
+                self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.options, self.ytdl_class))
+            else:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="ytdl", initializer=_init_worker, initargs=(self.options, self.ytdl_class))
+        return self.executor
+
+    async def iter_playlist(self, url: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield flat playlist entries as they are discovered.
+
+        Playlist walks only fetch listing pages, so they run on their own small thread
+        pool (whatever the backend) instead of holding up single-song lookups.
+        """
+        if self.flat_executor is None:
+            self.flat_executor = ThreadPoolExecutor(self.playlist_workers, thread_name_prefix="ytdl-playlist", initializer=_init_flat_worker, initargs=(self.options, self.ytdl_class))
+        loop = asyncio.get_running_loop()
+        entries: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def push(item):
+            try:
+                loop.call_soon_threadsafe(entries.put_nowait, item)
+            except RuntimeError:
+                stop.set()  # Event loop is gone
+
+        loop.run_in_executor(self.flat_executor, _iter_flat, url, push, stop, done)
+        try:
+            while True:
+                item = await entries.get()
+                if item is done:
+                    return
+                if isinstance(item, ExtractionError):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    async def extract(self, url: str, *, guild_id: int = 0, download: bool = False) -> Optional[Dict[str, Any]]:
+        """Run ytdl.extract_info in the pool and return the sanitized info dict"""
+        key = (url, download)
+        job = self.inflight.get(key)
+        if job is not None:
+            self.deduplicated += 1
+        else:
+            if self.pending_count >= self.max_pending:
+                raise ExtractionBusy("Too many songs are being looked up right now, please try again in a moment.")
+            job = _Job(key, guild_id, asyncio.get_running_loop().create_future())
+            self.inflight[key] = job
+            self.pending.setdefault(guild_id, deque()).append(job)
+            self.pending_count += 1
+            self._dispatch()
+
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        finally:
+            job.waiters -= 1
+            if job.waiters == 0 and not job.future.done():
+                self._abandon(job)
+
+    def _abandon(self, job: _Job):
+        if job.started:
+            # Can't interrupt a worker mid-extraction; just stop anyone else joining it
+            if self.inflight.get(job.key) is job:
+                del self.inflight[job.key]
+            return
+        jobs = self.pending.get(job.guild_id)
+        if jobs is not None:
+            jobs.remove(job)
+            self.pending_count -= 1
+            if not jobs:
+                del self.pending[job.guild_id]
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+        job.future.cancel()
+
+    def _next_job(self) -> Optional[_Job]:
+        """Take one job from the guild at the head of the rotation"""
+        if not self.pending:
+            return None
+        guild_id, jobs = self.pending.popitem(last=False)
+        job = jobs.popleft()
+        self.pending_count -= 1
+        if jobs:
+            self.pending[guild_id] = jobs
+        return job
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            self.running += 1
+            work = loop.run_in_executor(self._get_executor(), _extract, job.key[0], job.key[1])
+            work.add_done_callback(lambda w, job=job: self._finish(job, w))
+
+    def _finish(self, job: _Job, work: asyncio.Future):
+        self.running -= 1
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+        if not job.future.done():
+            if work.cancelled():
+                job.future.cancel()
+            elif work.exception() is not None:
+                job.future.set_exception(work.exception())
+                if job.waiters == 0:
+                    job.future.exception()  # Abandoned mid-run; nobody will retrieve it
+            else:
+                job.future.set_result(work.result())
+        elif not work.cancelled():
+            work.exception()  # Nobody is waiting; mark the exception retrieved
+        self._dispatch()
+
+    async def warm_up(self):
+        """Start every worker so yt-dlp is imported before the first lookup needs it"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, _warm) for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.flat_executor is not None:
+            self.flat_executor.shutdown(wait=False)
+            self.flat_executor = None
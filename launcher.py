@@ -0,0 +1,150 @@
+"""Run the bot as several cluster processes, each owning a contiguous range of shards.
+
+Every cluster is a normal `python bot.py` process with SHARD_COUNT, SHARD_IDS and
+CLUSTER_ID set, so it keeps its own event loop, voice connections and music queues.
+With METRICS_PORT set, cluster N serves its metrics on METRICS_PORT + N.
+Crashed clusters are restarted with backoff.
+
+Usage:
+    python launcher.py --clusters 4               # shard count from Discord's recommendation
+    python launcher.py --clusters 2 --shards 8    # fixed shard count
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("launcher")
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+# Restart delays grow up to this after repeated crashes
+MAX_BACKOFF = 60
+
+def recommended_shards(token: str) -> int:
+    """Ask Discord how many shards this bot should run"""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (launcher, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return int(json.load(response)["shards"])
+
+def split_shards(shard_count: int, clusters: int):
+    """Split shard IDs 0..shard_count-1 into contiguous, evenly sized ranges"""
+    clusters = max(1, min(clusters, shard_count))
+    base, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for i in range(clusters):
+        size = base + (1 if i < extra else 0)
+        ranges.append(range(start, start + size))
+        start += size
+    return ranges
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids: range, shard_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.failures = 0
+        self.started_at = 0.0
+        self.restart_at = 0.0
+
+    def environment(self):
+        env = dict(os.environ)
+        env["SHARD_COUNT"] = str(self.shard_count)
+        env["SHARD_IDS"] = f"{self.shard_ids.start}-{self.shard_ids.stop - 1}"
+        env["CLUSTER_ID"] = str(self.cluster_id)
+        metrics_port = int(env.get("METRICS_PORT") or 0)
+        if metrics_port:
+            # Clusters share the host, so each needs a port of its own
+            env["METRICS_PORT"] = str(metrics_port + self.cluster_id)
+        return env
+
+    def start(self):
+        env = self.environment()
+        logger.info(f"Starting cluster {self.cluster_id} with shards {env['SHARD_IDS']} of {self.shard_count}")
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started_at = time.monotonic()
+
+    def poll(self):
+        """Restart the cluster if it exited"""
+        if self.process is not None:
+            code = self.process.poll()
+            if code is None:
+                # A cluster that stays up for a while has recovered
+                if self.failures and time.monotonic() - self.started_at > MAX_BACKOFF:
+                    self.failures = 0
+                return
+            self.failures += 1
+            delay = min(MAX_BACKOFF, 2 ** self.failures)
+            logger.warning(f"Cluster {self.cluster_id} exited with code {code}, restarting in {delay}s")
+            self.process = None
+            self.restart_at = time.monotonic() + delay
+        if time.monotonic() >= self.restart_at:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the bot as multiple shard clusters")
+    parser.add_argument("--clusters", type=int, default=int(os.getenv("CLUSTERS", "1")), help="number of processes")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")), help="total shards (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    token = os.getenv("DISCORD_TOKEN")
+    if not token:
+        logger.error("DISCORD_TOKEN not found in environment variables")
+        sys.exit(1)
+
+    shard_count = args.shards or recommended_shards(token)
+    clusters = [Cluster(i, shard_ids, shard_count) for i, shard_ids in enumerate(split_shards(shard_count, args.clusters))]
+    logger.info(f"Running {shard_count} shard(s) across {len(clusters)} cluster(s)")
+
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for cluster in clusters:
+        if stopping:
+            break
+        cluster.start()
+        # Discord allows one IDENTIFY per 5 seconds; let this cluster's shards connect first
+        time.sleep(5 * len(cluster.shard_ids))
+    while not stopping:
+        for cluster in clusters:
+            cluster.poll()
+        time.sleep(1)
+
+    logger.info("Stopping clusters")
+    for cluster in clusters:
+        cluster.stop()
+    for cluster in clusters:
+        if cluster.process is not None:
+            try:
+                cluster.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                cluster.process.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+# Only what the bot reads back; full info dicts carry hundreds of KB of format lists
+CACHED_FIELDS = ('id', 'title', 'duration', 'webpage_url', 'thumbnail', 'uploader',
+                 'url', 'acodec', 'abr', 'ext', 'extractor')
+
+YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com'}
+
+def normalize_key(query: str) -> str:
+    """Cache key for a URL or a free-text search"""
+    query = query.strip()
+    parsed = urlparse(query)
+    if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+        return 'search:' + ' '.join(query.lower().split())
+
+    host = parsed.netloc.lower()
+    params = parse_qs(parsed.query)
+    if host in YOUTUBE_HOSTS and parsed.path == '/watch' and params.get('v'):
+        return 'youtube:' + params['v'][0]
+    if host == 'youtu.be' and parsed.path.strip('/'):
+        return 'youtube:' + parsed.path.strip('/')
+    if host in YOUTUBE_HOSTS and parsed.path.startswith('/shorts/'):
+        return 'youtube:' + parsed.path.split('/')[2]
+    query_string = urlencode(sorted((k, v) for k, values in params.items() for v in values))
+    return f"url:{host}{parsed.path.rstrip('/')}" + (f"?{query_string}" if query_string else '')
+
+class MetadataCache:
+    """Two-tier cache of yt-dlp lookups: an in-memory LRU in front of SQLite.
+
+    Song metadata and stream URLs age separately. Once a stream URL has expired the
+    entry is still served for metadata, just without 'url', so the caller knows to
+    resolve the stream again. SQLite is only touched from one dedicated thread.
+    """
+
+    def __init__(self, path: str, *, memory_size: int = 1024, max_rows: int = 50000,
+                 metadata_ttl: float = 7 * 24 * 3600, stream_margin: float = 600):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.metadata_ttl = metadata_ttl
+        self.stream_margin = stream_margin
+        self.memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="metadata-cache")
+        self.db: Optional[sqlite3.Connection] = None
+        self.writes = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stale_streams': 0, 'evictions': 0, 'disk_evictions': 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, info TEXT NOT NULL, stored_at REAL NOT NULL, '
+                'stream_expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)')
+        return self.db
+
+    def _read(self, key):
+        db = self._connect()
+        row = db.execute('SELECT info, stored_at, stream_expires_at FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        db.commit()
+        return {'info': json.loads(row[0]), 'stored_at': row[1], 'stream_expires_at': row[2]}
+
+    def _write(self, keys, entry):
+        db = self._connect()
+        now = time.time()
+        info = json.dumps(entry['info'])
+        db.executemany(
+            'INSERT OR REPLACE INTO entries (key, info, stored_at, stream_expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            [(key, info, entry['stored_at'], entry['stream_expires_at'], now) for key in keys],
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            db.execute('DELETE FROM entries WHERE stored_at < ?', (now - self.metadata_ttl,))
+            count = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            if count > self.max_rows:
+                db.execute(
+                    'DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)',
+                    (count - self.max_rows,),
+                )
+                self.stats['disk_evictions'] += count - self.max_rows
+        db.commit()
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    async def get(self, query: str, *, fresh_stream: bool = False) -> Optional[Dict[str, Any]]:
+        """Cached info dict for a URL or search, or None on a miss.
+
+        With fresh_stream, an entry whose stream URL has expired counts as a miss.
+        """
+        key = normalize_key(query)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            tier = 'memory_hits'
+        else:
+            loop = asyncio.get_running_loop()
+            entry = await loop.run_in_executor(self.executor, self._read, key)
+            tier = 'disk_hits'
+        now = time.time()
+        if entry is None or now - entry['stored_at'] > self.metadata_ttl:
+            self.stats['misses'] += 1
+            return None
+        if tier == 'disk_hits':
+            self._remember(key, entry)
+
+        info = dict(entry['info'])
+        if now > entry['stream_expires_at'] - self.stream_margin:
+            info.pop('url', None)
+            if fresh_stream:
+                self.stats['stale_streams'] += 1
+                return None
+        self.stats[tier] += 1
+        return info
+
+    async def put(self, query: str, info: Dict[str, Any], stream_expires_at: float):
+        """Store a lookup under its own key and its canonical page URL"""
+        entry = {
+            'info': {field: info[field] for field in CACHED_FIELDS if info.get(field) is not None},
+            'stored_at': time.time(),
+            'stream_expires_at': stream_expires_at,
+        }
+        keys = {normalize_key(query)}
+        if info.get('webpage_url'):
+            keys.add(normalize_key(info['webpage_url']))
+        for key in keys:
+            self._remember(key, entry)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._write, sorted(keys), entry)
+
+    def hit_ratio(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses'] + self.stats['stale_streams']
+        return hits / total if total else 0.0
+
+    def close(self):
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        self.executor.submit(close_db)
+        self.executor.shutdown(wait=True)
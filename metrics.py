@@ -0,0 +1,155 @@
+"""Minimal Prometheus-style metrics with an optional local HTTP endpoint.
+
+Metrics are plain counters and bucket arrays updated from the event loop (or, for
+the rare callback from an audio thread, under the GIL), so recording a sample costs
+a dict lookup and a few additions. Gauges that describe current state are computed
+only when the endpoint is scraped.
+"""
+import asyncio
+import bisect
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: Dict[str, "Metric"] = {}
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        # Re-registering a name replaces the old metric, e.g. when a cog is reloaded
+        _registry[name] = self
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Metric):
+    """A gauge whose value is read from a callback at scrape time.
+
+    The callback returns a number, or a dict of label tuples to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+        self.values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        values = dict(self.values)
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception as e:
+                logger.warning(f"Gauge {self.name} failed: {e}")
+                result = None
+            if isinstance(result, dict):
+                values.update(result)
+            elif result is not None:
+                values[()] = result
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum, count]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry.values()) + "\n"
+
+async def measure_loop_lag(gauge: Gauge, histogram: Histogram, interval: float = 0.5):
+    """Sample how late the event loop wakes a sleeping task"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        gauge.set(lag)
+        histogram.observe(lag)
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Serve /metrics on a local port"""
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
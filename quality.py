@@ -0,0 +1,130 @@
+"""Quality profiles for new streams, stepped down as the host gets busy.
+
+Only streams that start while the host is loaded get a cheaper profile; songs that
+are already playing keep the one they started with, so a spike never degrades
+every guild at once.
+"""
+import logging
+import os
+import time
+from typing import Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+class QualityProfile:
+    """Settings for whatever Opus encoding a stream needs.
+
+    Opus sources played in opus mode are copied untouched whatever the profile;
+    the profile only matters when ffmpeg transcodes (bitrate, compression level)
+    or when discord.py encodes PCM (bitrate, bandwidth, complexity).
+    """
+    __slots__ = ('name', 'bitrate', 'compression_level', 'bandwidth')
+
+    def __init__(self, name: str, *, bitrate: int, compression_level: int, bandwidth: str):
+        self.name = name
+        self.bitrate = bitrate  # kbps
+        self.compression_level = compression_level  # libopus complexity 0-10; lower is cheaper
+        self.bandwidth = bandwidth  # discord.py encoder bandwidth
+
+    def __repr__(self):
+        return f"<QualityProfile {self.name}>"
+
+# Best first; the monitor steps down this list as load rises
+PROFILES = (
+    QualityProfile("high", bitrate=128, compression_level=10, bandwidth="full"),
+    QualityProfile("balanced", bitrate=96, compression_level=5, bandwidth="full"),
+    QualityProfile("economy", bitrate=64, compression_level=0, bandwidth="superwide"),
+)
+
+def parse_thresholds(value: Optional[str], steps: int) -> Tuple[float, ...]:
+    """'0.7,0.85' -> (0.7, 0.85); empty disables the check"""
+    if not value or not value.strip():
+        return ()
+    thresholds = tuple(sorted(float(part) for part in value.split(',') if part.strip()))
+    return thresholds[:steps]
+
+class CpuSampler:
+    """Host CPU use between samples, from /proc/stat, or the load average elsewhere"""
+
+    def __init__(self):
+        self.last: Optional[Tuple[int, int]] = self._read()
+
+    @staticmethod
+    def _read() -> Optional[Tuple[int, int]]:
+        try:
+            with open('/proc/stat') as f:
+                fields = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+        return sum(fields), idle
+
+    def sample(self) -> float:
+        """Busy share of all CPUs since the previous sample, 0.0-1.0"""
+        current = self._read()
+        if current is None:
+            try:
+                return min(1.0, os.getloadavg()[0] / (os.cpu_count() or 1))
+            except (OSError, AttributeError):
+                return 0.0
+        previous, self.last = self.last or current, current
+        total = current[0] - previous[0]
+        idle = current[1] - previous[1]
+        return (total - idle) / total if total > 0 else 0.0
+
+class LoadMonitor:
+    """Picks the profile new streams start with from CPU use and live stream count.
+
+    Each threshold crossed steps one profile down, straight away. Stepping back up
+    takes one level at a time, and only once load has stayed below the thresholds
+    scaled by `hysteresis` for `recover_after` seconds, so the level doesn't flap
+    around a threshold.
+    """
+
+    def __init__(self, profiles: Sequence[QualityProfile] = PROFILES, *, cpu_thresholds: Sequence[float] = (0.7, 0.85),
+                 stream_thresholds: Sequence[float] = (), hysteresis: float = 0.8, recover_after: float = 60.0):
+        self.profiles = tuple(profiles)
+        self.cpu_thresholds = tuple(cpu_thresholds)
+        self.stream_thresholds = tuple(stream_thresholds)
+        self.hysteresis = hysteresis
+        self.recover_after = recover_after
+        self.level = 0
+        self.calm_since: Optional[float] = None
+        self.cpu = 0.0
+        self.streams = 0
+        self.changes = 0
+
+    @property
+    def profile(self) -> QualityProfile:
+        return self.profiles[self.level]
+
+    def _level_for(self, cpu: float, streams: int, scale: float) -> int:
+        cpu_level = sum(1 for t in self.cpu_thresholds if cpu >= t * scale)
+        stream_level = sum(1 for t in self.stream_thresholds if streams >= t * scale)
+        return min(len(self.profiles) - 1, max(cpu_level, stream_level))
+
+    def update(self, cpu: float, streams: int, now: Optional[float] = None) -> QualityProfile:
+        now = time.monotonic() if now is None else now
+        self.cpu = cpu
+        self.streams = streams
+        down = self._level_for(cpu, streams, 1.0)
+        up = self._level_for(cpu, streams, self.hysteresis)
+        if down > self.level:
+            self._set(down, f"CPU {cpu:.0%}, {streams} live stream(s)")
+            self.calm_since = None
+        elif up < self.level:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= self.recover_after:
+                self._set(self.level - 1, f"load back down to CPU {cpu:.0%}, {streams} live stream(s)")
+                self.calm_since = now  # Another full calm period before the next step up
+        else:
+            self.calm_since = None
+        return self.profile
+
+    def _set(self, level: int, reason: str):
+        previous = self.profile
+        log = logger.warning if level > self.level else logger.info
+        self.level = level
+        self.changes += 1
+        log(f"Quality profile for new streams: {previous.name} -> {self.profile.name} ({reason})")
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class QueueStore:
+    """Write-behind persistence of per-guild music sessions in SQLite.
+
+    Callers only mark guilds dirty; a background task snapshots them on the event
+    loop at most once per interval and hands the batch to a dedicated writer thread.
+    The queue and the playback position are tracked separately, so the frequent
+    position updates don't rewrite long queues.
+    """
+
+    def __init__(self, path: str, *, interval: float = 2.0):
+        self.path = path
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="queue-store")
+        self.db: Optional[sqlite3.Connection] = None
+        self.dirty_queues: Set[int] = set()
+        self.dirty_positions: Set[int] = set()
+        self.wakeup = asyncio.Event()
+        self.frozen = False
+        self.task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'guild_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, queue TEXT NOT NULL, '
+                'current TEXT, position REAL NOT NULL, paused INTEGER NOT NULL, updated_at REAL NOT NULL)'
+            )
+        return self.db
+
+    def mark_queue(self, guild_id: int):
+        """The queue, current track or modes changed"""
+        if not self.frozen:
+            self.dirty_queues.add(guild_id)
+            self.wakeup.set()
+
+    def mark_position(self, guild_id: int):
+        """Only the playback position moved"""
+        if not self.frozen:
+            self.dirty_positions.add(guild_id)
+            self.wakeup.set()
+
+    def start(self, snapshot: Callable[[int, bool], Optional[Dict[str, Any]]]):
+        """Begin flushing in the background.
+
+        snapshot(guild_id, full) returns the session state, or None when the guild has
+        no session; with full=False the 'queue' entry may be left out.
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(snapshot))
+
+    async def _run(self, snapshot):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                await self.flush(snapshot)
+            except Exception as e:
+                logger.error(f"Failed to save queues: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def flush(self, snapshot):
+        queues, self.dirty_queues = self.dirty_queues, set()
+        positions, self.dirty_positions = self.dirty_positions - queues, set()
+        if not queues and not positions:
+            return
+        # Snapshot on the loop so the state is consistent; encoding and I/O happen on the writer thread
+        full = {guild_id: snapshot(guild_id, True) for guild_id in queues}
+        partial = {guild_id: snapshot(guild_id, False) for guild_id in positions}
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._write, full, partial)
+
+    def _write(self, full, partial):
+        db = self._connect()
+        now = time.time()
+        with db:
+            for guild_id, state in full.items():
+                if state is None:
+                    db.execute('DELETE FROM sessions WHERE guild_id = ?', (guild_id,))
+                    continue
+                db.execute(
+                    'INSERT OR REPLACE INTO sessions (guild_id, channel_id, queue, current, position, paused, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (guild_id, state['channel_id'], json.dumps(state['queue']), json.dumps(state['current']),
+                     state['position'], int(state['paused']), now),
+                )
+            for guild_id, state in partial.items():
+                if state is None:
+                    continue
+                db.execute(
+                    'UPDATE sessions SET current = ?, position = ?, paused = ?, updated_at = ? WHERE guild_id = ?',
+                    (json.dumps(state['current']), state['position'], int(state['paused']), now, guild_id),
+                )
+
+    def _read_all(self):
+        db = self._connect()
+        rows = db.execute('SELECT guild_id, channel_id, queue, current, position, paused, updated_at FROM sessions').fetchall()
+        return {
+            row[0]: {
+                'channel_id': row[1],
+                'queue': json.loads(row[2]),
+                'current': json.loads(row[3]) if row[3] else None,
+                'position': row[4],
+                'paused': bool(row[5]),
+                'updated_at': row[6],
+            }
+            for row in rows
+        }
+
+    async def load_all(self) -> Dict[int, Dict[str, Any]]:
+        """Every saved session, keyed by guild ID"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._read_all)
+
+    async def close(self, snapshot):
+        """Write whatever is pending and stop accepting changes.
+
+        Called before shutdown disconnects from voice, so the sessions being torn
+        down are saved rather than recorded as ended.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.frozen = True
+        try:
+            await self.flush(snapshot)
+        except Exception as e:
+            logger.error(f"Failed to save queues: {e}")
+        loop = asyncio.get_running_loop()
+
+        def close_db():
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        await loop.run_in_executor(self.executor, close_db)
+        self.executor.shutdown(wait=False)
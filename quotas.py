@@ -0,0 +1,95 @@
+"""Admission limits for /play, so one busy server can't crowd out the rest.
+
+Checks are plain counters and token buckets, so a rejected request costs a few
+dict lookups and never reaches yt-dlp or ffmpeg.
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Rate limit buckets are only kept for this many recently active guilds; an evicted
+# bucket had refilled anyway unless the guild was very busy
+MAX_TRACKED_GUILDS = 10000
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Take a token; 0.0 if there was one, else seconds until there will be"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class QuotaExceeded(Exception):
+    """A request turned away by a limit; the message is meant for the user"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+class Quotas:
+    """Per-guild and global limits on /play.
+
+    Per guild: requests per minute (token bucket), songs in the queue and lookups
+    in progress at once. Globally: requests per minute and voice streams playing.
+    A limit of 0 disables that check.
+    """
+
+    def __init__(self, *, play_rate: float = 0, play_burst: int = 5, global_play_rate: float = 0, global_play_burst: int = 50,
+                 max_queue: int = 0, max_lookups: int = 0, max_streams: int = 0):
+        self.play_rate = play_rate / 60
+        self.play_burst = play_burst
+        self.global_bucket = TokenBucket(global_play_rate / 60, global_play_burst) if global_play_rate > 0 else None
+        self.max_queue = max_queue
+        self.max_lookups = max_lookups
+        self.max_streams = max_streams
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.lookups: Dict[int, int] = {}
+
+    def admit_play(self, guild_id: int, *, queued: int, new_stream: bool, streams: int):
+        """Reserve a lookup slot for a /play, or raise QuotaExceeded; pair with release_play"""
+        if self.max_queue and queued >= self.max_queue:
+            raise QuotaExceeded("queue_full", f"📜 The queue is full ({self.max_queue} songs). Skip or remove some first.")
+        if self.max_lookups and self.lookups.get(guild_id, 0) >= self.max_lookups:
+            raise QuotaExceeded("lookups", "⏳ Still looking up this server's last few songs, please wait for them first.")
+        if self.max_streams and new_stream and streams >= self.max_streams:
+            raise QuotaExceeded("voice_streams", "🔇 The bot is playing in as many servers as it can right now, please try again later.")
+        if self.play_rate > 0:
+            bucket = self.buckets.get(guild_id)
+            if bucket is None:
+                bucket = self.buckets[guild_id] = TokenBucket(self.play_rate, self.play_burst)
+                while len(self.buckets) > MAX_TRACKED_GUILDS:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(guild_id)
+            wait = bucket.take()
+            if wait:
+                raise QuotaExceeded("rate", f"🐢 This server is adding songs too quickly, try again in {math.ceil(wait)}s.")
+        if self.global_bucket is not None:
+            wait = self.global_bucket.take()
+            if wait:
+                raise QuotaExceeded("global_rate", f"🐢 The bot is very busy, try again in {math.ceil(wait)}s.")
+        self.lookups[guild_id] = self.lookups.get(guild_id, 0) + 1
+
+    def release_play(self, guild_id: int):
+        count = self.lookups.get(guild_id, 0) - 1
+        if count > 0:
+            self.lookups[guild_id] = count
+        else:
+            self.lookups.pop(guild_id, None)
+
+    def queue_room(self, queued: int) -> Optional[int]:
+        """Songs that still fit in a queue of this length, or None if unlimited"""
+        return max(0, self.max_queue - queued) if self.max_queue else None
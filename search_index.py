@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import logging
+import re
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+def normalize(text: str) -> str:
+    return " ".join(_WORD.findall(text.lower()))
+
+def trigrams(text: str) -> Set[str]:
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchEntry:
+    __slots__ = ('url', 'title', 'uploader', 'duration', 'text', 'grams', 'words', 'plays')
+
+    def __init__(self, url, title, uploader, duration):
+        self.url = url
+        self.title = title
+        self.uploader = uploader
+        self.duration = duration
+        self.text = ''
+        self.grams: Set[str] = set()
+        self.words: Set[str] = set()
+        self.plays = 0
+
+class SearchIndex:
+    """In-memory index of song titles for /play autocomplete.
+
+    Entries are matched by word prefix for short input and by trigram overlap once
+    there are three or more characters, so typos and partial words still match.
+    The least recently touched entries are dropped past max_entries.
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, SearchEntry]" = OrderedDict()
+        self.by_gram: Dict[str, Set[str]] = {}
+        self.by_word: Dict[str, Set[str]] = {}
+        self.words: List[str] = []  # Sorted, for prefix lookups
+
+    def add(self, url: str, title: str, *, uploader: str = '', duration: int = 0, query: Optional[str] = None, played: bool = False):
+        """Index a song; the search text that found it becomes searchable too"""
+        if not url or not title:
+            return
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = SearchEntry(url, title, uploader, duration)
+            self._reindex(entry, normalize(f"{title} {uploader}"))
+        else:
+            self.entries.move_to_end(url)
+        if query and normalize(query) not in entry.text:
+            self._reindex(entry, f"{entry.text} {normalize(query)}")
+        if played:
+            entry.plays += 1
+        while len(self.entries) > self.max_entries:
+            _, old = self.entries.popitem(last=False)
+            self._unindex(old)
+
+    def _reindex(self, entry: SearchEntry, text: str):
+        self._unindex(entry)
+        entry.text = text
+        entry.grams = trigrams(text)
+        entry.words = set(text.split())
+        for gram in entry.grams:
+            self.by_gram.setdefault(gram, set()).add(entry.url)
+        for word in entry.words:
+            urls = self.by_word.get(word)
+            if urls is None:
+                urls = self.by_word[word] = set()
+                bisect.insort(self.words, word)
+            urls.add(entry.url)
+
+    def _unindex(self, entry: SearchEntry):
+        for gram in entry.grams:
+            urls = self.by_gram.get(gram)
+            if urls is not None:
+                urls.discard(entry.url)
+                if not urls:
+                    del self.by_gram[gram]
+        for word in entry.words:
+            urls = self.by_word.get(word)
+            if urls is not None:
+                urls.discard(entry.url)
+                if not urls:
+                    del self.by_word[word]
+                    self.words.pop(bisect.bisect_left(self.words, word))
+
+    def _prefixed(self, prefix: str) -> Set[str]:
+        urls = set()
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            urls |= self.by_word[self.words[i]]
+            i += 1
+        return urls
+
+    def search(self, query: str, limit: int = 25) -> List[SearchEntry]:
+        """Best matches for what has been typed so far"""
+        text = normalize(query)
+        if not text:
+            recent = sorted(reversed(self.entries.values()), key=lambda e: e.plays, reverse=True)
+            return recent[:limit]
+        words = text.split()
+        if len(text) < 3:
+            matches = self._prefixed(words[-1])
+            scores = {url: 1.0 for url in matches}
+        else:
+            grams = trigrams(text)
+            counts = Counter()
+            for gram in grams:
+                counts.update(self.by_gram.get(gram, ()))
+            scores = {url: count / len(grams) for url, count in counts.items() if count / len(grams) >= 0.4}
+            # Whole words typed so far, with the last one possibly unfinished
+            for url in self._prefixed(words[-1]):
+                if url in scores:
+                    scores[url] += 0.5
+        ranked = sorted(scores, key=lambda url: (scores[url], self.entries[url].plays), reverse=True)
+        return [self.entries[url] for url in ranked[:limit]]
+
+    def __len__(self):
+        return len(self.entries)
+
+class DebouncedSearch:
+    """Runs a background search once someone stops typing.
+
+    Each key (a user) has one pending timer, so only the last text typed is looked
+    up; queries already searched are skipped and at most max_running run at once.
+    """
+
+    def __init__(self, search: Callable[[str], Awaitable[None]], *, delay: float = 0.75,
+                 max_running: int = 1, remember: int = 2048):
+        self.search = search
+        self.delay = delay
+        self.max_running = max_running
+        self.remember = remember
+        self.timers: Dict[int, asyncio.TimerHandle] = {}
+        self.searched: "OrderedDict[str, None]" = OrderedDict()
+        self.running = 0
+        self.tasks: Set[asyncio.Task] = set()
+
+    def request(self, key: int, query: str):
+        text = normalize(query)
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if len(text) < 3 or text in self.searched:
+            return
+        self.timers[key] = asyncio.get_running_loop().call_later(self.delay, self._fire, key, text)
+
+    def _fire(self, key: int, text: str):
+        self.timers.pop(key, None)
+        if self.running >= self.max_running or text in self.searched:
+            return
+        self.searched[text] = None
+        while len(self.searched) > self.remember:
+            self.searched.popitem(last=False)
+        self.running += 1
+        task = asyncio.create_task(self._run(text))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, text: str):
+        try:
+            await self.search(text)
+        except Exception as e:
+            logger.warning(f"Background search for {text!r} failed: {e}")
+        finally:
+            self.running -= 1
+
+    def cancel_all(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for task in self.tasks:
+            task.cancel()
@@ -0,0 +1,227 @@
+import logging
+import threading
+from typing import Callable, Dict, Hashable, List, Optional
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# discord.py sends one 20 ms frame per read()
+FRAME_SECONDS = 0.02
+# How far the reader may run ahead of the furthest consumer
+READ_AHEAD_FRAMES = int(5 / FRAME_SECONDS)
+
+class SharedStream:
+    """One decoder whose frames are read by several voice clients at their own pace.
+
+    A reader thread pulls frames from a single audio source into a ring buffer of
+    the last `capacity` frames. Consumers keep their own frame index; a consumer
+    that falls out of the ring (paused for too long, say) switches to a private
+    source of its own. The reader stops and cleans up the source once the last
+    consumer leaves.
+    """
+
+    def __init__(self, key: Hashable, source: discord.AudioSource, *, capacity: int, on_close: Optional[Callable] = None):
+        self.key = key
+        self.source = source
+        self.capacity = max(capacity, READ_AHEAD_FRAMES * 2)
+        self.ring: List[Optional[bytes]] = [None] * self.capacity
+        self.end = 0  # Index of the next frame the reader will store
+        self.consumers: List["SharedSource"] = []
+        self.condition = threading.Condition()
+        self.finished = False
+        self.closed = False
+        self.on_close = on_close
+        self.thread = threading.Thread(target=self._run, name=f"shared-audio-{key}", daemon=True)
+        self.started = False
+
+    @property
+    def start(self) -> int:
+        """Index of the oldest frame still buffered"""
+        return max(0, self.end - self.capacity)
+
+    def _leader(self) -> int:
+        return max((c.position for c in self.consumers), default=0)
+
+    def _joinable(self) -> bool:
+        return not self.closed and self.start == 0 and self._leader() + READ_AHEAD_FRAMES < self.capacity
+
+    def joinable(self) -> bool:
+        """Whether a late consumer could still start from the first frame"""
+        with self.condition:
+            return self._joinable()
+
+    def attach(self, consumer: "SharedSource", *, late: bool = False) -> bool:
+        """Add a consumer; a late one is only taken while the first frame is still
+        buffered and there is room left for it to keep up"""
+        with self.condition:
+            if self.closed or (late and not self._joinable()):
+                return False
+            self.consumers.append(consumer)
+            if not self.started:
+                self.started = True
+                self.thread.start()
+        return True
+
+    def detach(self, consumer: "SharedSource"):
+        with self.condition:
+            if consumer in self.consumers:
+                self.consumers.remove(consumer)
+            if self.consumers or self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        if self.on_close:
+            self.on_close(self)
+        if not self.started:
+            self.source.cleanup()
+
+    def _run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.closed and self.end - self._leader() >= READ_AHEAD_FRAMES:
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                data = self.source.read()
+                if data.startswith((b'OpusHead', b'OpusTags')):
+                    continue
+                with self.condition:
+                    if not data:
+                        return
+                    self.ring[self.end % self.capacity] = data
+                    self.end += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            logger.error(f"Shared audio reader for {self.key} failed: {e}")
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            self.source.cleanup()
+
+    def frame(self, index: int) -> Optional[bytes]:
+        """Frame at index: b'' at the end of the track, None if it has left the ring"""
+        with self.condition:
+            if index < self.start:
+                return None
+            if index >= self.end:
+                # Blocks like a read from ffmpeg's pipe would until the reader catches up
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: index < self.end or self.finished or self.closed)
+                if index >= self.end:
+                    return b''
+            return self.ring[index % self.capacity]
+
+    def advanced(self):
+        """A consumer moved; wake the reader if it was holding back"""
+        with self.condition:
+            if self.end - self._leader() < READ_AHEAD_FRAMES:
+                self.condition.notify_all()
+
+class SharedSource(discord.AudioSource):
+    """One voice client's view of a SharedStream.
+
+    The consumer joins a stream on its first read, when playback actually starts, so
+    a source prepared ahead of time holds no place in a stream and doesn't hold its
+    reader back. PCM unless a subclass says otherwise.
+    """
+
+    def __init__(self, streams: "SharedStreams", key: Hashable, *, spawn: Callable[[], discord.AudioSource],
+                 fallback: Callable[[float], discord.AudioSource]):
+        self.streams = streams
+        self.key = key
+        self.spawn = spawn
+        self.fallback = fallback
+        self.stream: Optional[SharedStream] = None
+        self.spare: Optional[discord.AudioSource] = None  # Spawned ahead in case there's nothing to join
+        self.position = 0
+        self.private: Optional[discord.AudioSource] = None
+        self.closed = False
+
+    def read(self) -> bytes:
+        if self.private is not None:
+            return self.private.read()
+        if self.stream is None:
+            if self.closed:
+                return b''
+            self.stream = self.streams.join(self)
+        data = self.stream.frame(self.position)
+        if data is None:
+            # Fell behind the buffer; carry on from the same spot with a source of our own
+            offset = self.position * FRAME_SECONDS
+            self.stream.detach(self)
+            logger.info(f"Shared audio consumer of {self.key} fell behind, continuing privately at {offset:.1f}s")
+            self.private = self.fallback(offset)
+            return self.private.read()
+        if data:
+            self.position += 1
+            if self.position % 25 == 0:
+                self.stream.advanced()
+        return data
+
+    def is_opus(self) -> bool:
+        return False
+
+    def take_spare(self) -> Optional[discord.AudioSource]:
+        spare, self.spare = self.spare, None
+        return spare
+
+    def cleanup(self):
+        self.closed = True
+        spare = self.take_spare()
+        if spare is not None:
+            spare.cleanup()
+        if self.private is not None:
+            self.private.cleanup()
+            self.private = None
+        elif self.stream is not None:
+            self.stream.detach(self)
+
+class SharedStreams:
+    """Registry of streams that new plays of the same track can join"""
+
+    def __init__(self, *, buffer_seconds: float = 60):
+        self.capacity = int(buffer_seconds / FRAME_SECONDS)
+        self.streams: Dict[Hashable, SharedStream] = {}
+        self.lock = threading.Lock()
+        self.stats = {'shared': 0, 'opened': 0}
+
+    def consume(self, key: Hashable, spawn: Callable[[], discord.AudioSource],
+                fallback: Callable[[float], discord.AudioSource], *, consumer_class=SharedSource) -> SharedSource:
+        """A source for this track that shares a stream once it starts playing"""
+        consumer = consumer_class(self, key, spawn=spawn, fallback=fallback)
+        with self.lock:
+            stream = self.streams.get(key)
+        if stream is None or not stream.joinable():
+            # Nothing to join yet; start the decoder now, as an unshared source would be
+            consumer.spare = spawn()
+        return consumer
+
+    def join(self, consumer: SharedSource) -> SharedStream:
+        """Attach a consumer that is starting to play to a stream of its track that is
+        still at its start, or open a new stream others can join"""
+        with self.lock:
+            stream = self.streams.get(consumer.key)
+        if stream is not None and stream.attach(consumer, late=True):
+            spare = consumer.take_spare()
+            if spare is not None:
+                spare.cleanup()
+            self.stats['shared'] += 1
+            return stream
+        stream = SharedStream(consumer.key, consumer.take_spare() or consumer.spawn(), capacity=self.capacity, on_close=self._closed)
+        stream.attach(consumer)
+        with self.lock:
+            self.streams[consumer.key] = stream
+        self.stats['opened'] += 1
+        return stream
+
+    def _closed(self, stream: SharedStream):
+        with self.lock:
+            if self.streams.get(stream.key) is stream:
+                del self.streams[stream.key]
+
+    def consumers(self) -> int:
+        with self.lock:
+            return sum(len(s.consumers) for s in self.streams.values())
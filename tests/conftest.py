@@ -0,0 +1,12 @@
+"""Makes the repository root importable and keeps the bot's caches and saved
+sessions out of the working tree. Runs before any test module imports `bot`."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["CACHE_DIR"] = os.path.join(_tmp.name, "cache")
+os.environ["DATA_DIR"] = os.path.join(_tmp.name, "data")
+os.environ.setdefault("DISCORD_TOKEN", "")
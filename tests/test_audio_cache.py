@@ -0,0 +1,23 @@
+import asyncio
+
+import audio_cache
+from audio_cache import AudioCache
+
+def test_cache_built_outside_a_loop_populates_under_asyncio_run(tmp_path, monkeypatch):
+    async def slow_failing_ffmpeg(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        raise OSError("no ffmpeg in this test")
+
+    monkeypatch.setattr(audio_cache.asyncio, "create_subprocess_exec", slow_failing_ffmpeg)
+    # Built at import time in the bot, before asyncio.run starts the loop
+    cache = AudioCache(str(tmp_path), max_bytes=2 ** 20, min_plays=1, max_populating=1)
+
+    async def main():
+        # More tracks than slots, so populating has to wait on the semaphore
+        for i in range(3):
+            cache.record_play(f"track {i}", f"https://example.com/{i}", duration=10)
+        await asyncio.gather(*cache.populating.values())
+
+    asyncio.run(main())
+    assert cache.stats['failed'] == 3
+    assert not cache.populating
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+import pytest
+
+from extraction import ExtractionBusy, ExtractionPool
+
+class FakeYTDL:
+    """Stands in for yt_dlp.YoutubeDL; 'blocker' holds its worker until the gate opens"""
+
+    def __init__(self, calls, gate):
+        self.calls = calls
+        self.gate = gate
+
+    def extract_info(self, url, download=False):
+        self.calls.append(url)
+        if url == "blocker":
+            assert self.gate.wait(5)
+        return {'url': url, 'title': url}
+
+    def sanitize_info(self, info):
+        return info
+
+def make_pool(**kwargs):
+    calls = []
+    gate = threading.Event()
+    pool = ExtractionPool({}, workers=1, ytdl_class=lambda options: FakeYTDL(calls, gate), **kwargs)
+    return pool, calls, gate
+
+def test_guilds_take_turns():
+    pool, calls, gate = make_pool()
+
+    async def main():
+        blocker = asyncio.create_task(pool.extract("blocker", guild_id=0))
+        await asyncio.sleep(0)
+        lookups = [asyncio.create_task(pool.extract(url, guild_id=1)) for url in ("a1", "a2", "a3")]
+        lookups.append(asyncio.create_task(pool.extract("b1", guild_id=2)))
+        await asyncio.sleep(0)
+        assert pool.backlog == 4
+        gate.set()
+        await asyncio.gather(blocker, *lookups)
+
+    asyncio.run(main())
+    pool.shutdown()
+    assert calls == ["blocker", "a1", "b1", "a2", "a3"]
+
+def test_identical_lookups_share_one_extraction():
+    pool, calls, gate = make_pool()
+
+    async def main():
+        blocker = asyncio.create_task(pool.extract("blocker"))
+        await asyncio.sleep(0)
+        first = asyncio.create_task(pool.extract("song", guild_id=1))
+        second = asyncio.create_task(pool.extract("song", guild_id=2))
+        await asyncio.sleep(0)
+        gate.set()
+        await blocker
+        return await first, await second
+
+    first, second = asyncio.run(main())
+    pool.shutdown()
+    assert first == second == {'url': "song", 'title': "song"}
+    assert calls.count("song") == 1
+    assert pool.deduplicated == 1
+
+def test_full_queue_raises_busy():
+    pool, calls, gate = make_pool(max_pending=1)
+
+    async def main():
+        blocker = asyncio.create_task(pool.extract("blocker"))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(pool.extract("queued"))
+        await asyncio.sleep(0)
+        with pytest.raises(ExtractionBusy):
+            await pool.extract("one too many")
+        gate.set()
+        await asyncio.gather(blocker, queued)
+
+    asyncio.run(main())
+    pool.shutdown()
+    assert calls == ["blocker", "queued"]
+
+def test_timed_out_lookup_is_dropped_from_the_queue():
+    pool, calls, gate = make_pool()
+
+    async def main():
+        blocker = asyncio.create_task(pool.extract("blocker"))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pool.extract("late", guild_id=1), 0.05)
+        assert pool.backlog == 0
+        assert not pool.pending
+        gate.set()
+        await blocker
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    pool.shutdown()
+    assert calls == ["blocker"]
+    assert not pool.inflight
@@ -0,0 +1,83 @@
+import os
+import socket
+import textwrap
+import time
+import urllib.request
+
+import pytest
+
+import launcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port_pair():
+    """A port p where p and p + 1 are both free"""
+    for _ in range(50):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        try:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", port + 1))
+        except OSError:
+            continue
+        return port
+    pytest.skip("no two adjacent free ports")
+
+def fetch(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+                return response.read().decode()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def test_split_shards():
+    assert [list(r) for r in launcher.split_shards(5, 2)] == [[0, 1, 2], [3, 4]]
+    assert len(launcher.split_shards(2, 4)) == 2
+
+def test_clusters_get_their_own_metrics_port(monkeypatch):
+    monkeypatch.setenv("METRICS_PORT", "9100")
+    envs = [launcher.Cluster(i, shards, 4).environment() for i, shards in enumerate(launcher.split_shards(4, 2))]
+    assert [env["METRICS_PORT"] for env in envs] == ["9100", "9101"]
+    assert [env["SHARD_IDS"] for env in envs] == ["0-1", "2-3"]
+
+    monkeypatch.delenv("METRICS_PORT")
+    assert "METRICS_PORT" not in launcher.Cluster(1, range(2, 4), 4).environment()
+
+def test_two_clusters_serve_metrics(monkeypatch, tmp_path):
+    # Stands in for bot.py: serves metrics the way main() does, then idles like a connected bot
+    script = tmp_path / "cluster.py"
+    script.write_text(textwrap.dedent(f"""
+        import asyncio, os, sys
+        sys.path.insert(0, {ROOT!r})
+        import metrics
+
+        up = metrics.Gauge("cluster_up", "Cluster id", callback=lambda: float(os.environ["CLUSTER_ID"]))
+
+        async def main():
+            await metrics.start_server("127.0.0.1", int(os.environ["METRICS_PORT"]))
+            await asyncio.sleep(60)
+
+        asyncio.run(main())
+    """))
+    port = free_port_pair()
+    monkeypatch.setenv("METRICS_PORT", str(port))
+    monkeypatch.setattr(launcher, "BOT_SCRIPT", str(script))
+
+    clusters = [launcher.Cluster(i, shards, 2) for i, shards in enumerate(launcher.split_shards(2, 2))]
+    try:
+        for cluster in clusters:
+            cluster.start()
+        for cluster in clusters:
+            assert f"cluster_up {float(cluster.cluster_id)}" in fetch(port + cluster.cluster_id)
+        for cluster in clusters:
+            assert cluster.process.poll() is None  # Neither lost a race for the port
+    finally:
+        for cluster in clusters:
+            if cluster.process is not None:
+                cluster.process.kill()
+                cluster.process.wait()
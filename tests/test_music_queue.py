@@ -0,0 +1,54 @@
+import random
+
+import bot
+
+def make_queue(size):
+    queue = bot.MusicQueue()
+    for i in range(size):
+        queue.add(bot.Track(f"Song {i}", duration=200, webpage_url=f"https://www.youtube.com/watch?v={i:011d}"))
+    return queue
+
+def titles(tracks):
+    return [track.title for track in tracks]
+
+def test_advance_remove_and_pages():
+    queue = make_queue(10)
+    assert queue.get_next().title == "Song 0"
+    assert queue.remove(1).title == "Song 2"
+    queue.push_front(bot.Track("Front"))
+    assert titles(queue.page(1, size=3)) == ["Front", "Song 1", "Song 3"]
+    assert titles(queue.page(3, size=4)) == ["Song 9"]
+    assert queue[-1].title == "Song 9"
+    assert len(queue) == len(list(queue)) == 9
+
+def test_shuffle_plays_the_track_it_announced():
+    random.seed(1)
+    queue = make_queue(50)
+    queue.shuffle = True
+    for _ in range(100):
+        announced = queue.up_next()
+        assert queue.peek(3) == [announced]
+        # Unrelated changes don't re-roll the pick
+        queue.add(bot.Track("Late addition"))
+        queue.push_front(bot.Track("Jumped the queue"))
+        queue.remove(len(queue) - 1)
+        assert queue.up_next() is announced
+        queue.current = queue.get_next()
+        assert queue.current is announced
+
+def test_shuffle_repicks_when_the_next_track_is_removed():
+    queue = make_queue(5)
+    queue.shuffle = True
+    announced = queue.up_next()
+    queue.remove(list(queue).index(announced))
+    assert queue.up_next() is not None and queue.up_next() is not announced
+
+def test_loop_all_keeps_every_track():
+    queue = make_queue(4)
+    queue.loop_mode = "all"
+    played = []
+    for _ in range(9):
+        queue.current = queue.get_next()
+        played.append(queue.current)
+    assert titles(played[:5]) == ["Song 0", "Song 1", "Song 2", "Song 3", "Song 0"]
+    assert len(queue) == 3
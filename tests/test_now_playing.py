@@ -0,0 +1,79 @@
+import asyncio
+
+import bot
+
+INTERVAL = 0.05
+
+class FakeMessage:
+    def __init__(self):
+        self.id = 1
+        self.channel = self
+        self.edits = 0
+
+    def get_partial_message(self, message_id):
+        return self
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+
+class FakeMusic:
+    """Just the state NowPlaying reads"""
+
+    def __init__(self):
+        self.state = {}
+
+    def now_playing_state(self, guild_id):
+        return self.state.get(guild_id, ())
+
+    def now_playing_embed(self, guild_id):
+        return None, None
+
+def run(scenario):
+    async def main():
+        music = FakeMusic()
+        now_playing = bot.NowPlaying(music, INTERVAL)
+        message = FakeMessage()
+        await scenario(music, now_playing, message)
+        await asyncio.sleep(INTERVAL * 3)
+        return now_playing, message
+    return asyncio.run(main())
+
+def test_burst_of_changes_costs_one_edit():
+    async def scenario(music, now_playing, message):
+        music.state[1] = ("song 0",)
+        now_playing.attach(1, message)
+        for i in range(1, 6):
+            music.state[1] = (f"song {i}",)
+            now_playing.update(1)
+
+    now_playing, message = run(scenario)
+    assert message.edits == 1
+    assert now_playing.stats == {'requested': 5, 'edited': 1, 'failed': 0}
+    assert now_playing.saved() == 4
+
+def test_updates_that_change_nothing_shown_are_not_counted():
+    async def scenario(music, now_playing, message):
+        now_playing.update(1)  # No message yet
+        music.state[1] = ("song 0",)
+        now_playing.attach(1, message)
+        for _ in range(10):
+            now_playing.update(1)  # e.g. position saves, which the embed doesn't show
+
+    now_playing, message = run(scenario)
+    assert message.edits == 0
+    assert now_playing.stats['requested'] == 0
+    assert now_playing.saved() == 0
+
+def test_change_and_change_back_skips_the_edit():
+    async def scenario(music, now_playing, message):
+        music.state[1] = ("song 0", "playing")
+        now_playing.attach(1, message)
+        music.state[1] = ("song 0", "paused")
+        now_playing.update(1)
+        music.state[1] = ("song 0", "playing")
+        now_playing.update(1)
+
+    now_playing, message = run(scenario)
+    assert message.edits == 0
+    assert now_playing.stats['requested'] == 2
+    assert now_playing.saved() == 2
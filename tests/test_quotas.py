@@ -0,0 +1,62 @@
+import pytest
+
+from quotas import QuotaExceeded, Quotas, TokenBucket
+
+def test_bucket_spends_its_burst_then_refills_at_its_rate():
+    bucket = TokenBucket(rate=2, burst=3)
+    bucket.updated = 0.0
+    assert [bucket.take(now=0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(now=0.0) == pytest.approx(0.5)
+    assert bucket.take(now=0.5) == 0.0
+    # A long pause refills no more than the burst
+    bucket.take(now=100.0)
+    assert bucket.tokens == pytest.approx(2)
+
+def test_admit_play_checks_queue_lookups_and_streams():
+    quotas = Quotas(max_queue=10, max_lookups=2, max_streams=1)
+    with pytest.raises(QuotaExceeded) as e:
+        quotas.admit_play(1, queued=10, new_stream=False, streams=0)
+    assert e.value.reason == "queue_full"
+    with pytest.raises(QuotaExceeded) as e:
+        quotas.admit_play(1, queued=0, new_stream=True, streams=1)
+    assert e.value.reason == "voice_streams"
+    # Joining a guild that already has a stream doesn't count against the stream limit
+    quotas.admit_play(1, queued=0, new_stream=False, streams=1)
+    quotas.admit_play(1, queued=0, new_stream=False, streams=1)
+    with pytest.raises(QuotaExceeded) as e:
+        quotas.admit_play(1, queued=0, new_stream=False, streams=1)
+    assert e.value.reason == "lookups"
+    # Other guilds have their own lookup slots
+    quotas.admit_play(2, queued=0, new_stream=False, streams=1)
+
+def test_release_play_frees_lookup_slots():
+    quotas = Quotas(max_lookups=1)
+    quotas.admit_play(1, queued=0, new_stream=False, streams=0)
+    quotas.release_play(1)
+    assert quotas.lookups == {}
+    quotas.admit_play(1, queued=0, new_stream=False, streams=0)
+    assert quotas.lookups == {1: 1}
+    # An unmatched release never goes negative
+    quotas.release_play(1)
+    quotas.release_play(1)
+    assert quotas.lookups == {}
+
+def test_admit_play_rate_limits_per_guild_and_globally():
+    quotas = Quotas(play_rate=60, play_burst=2, global_play_rate=60, global_play_burst=3)
+    quotas.admit_play(1, queued=0, new_stream=False, streams=0)
+    quotas.admit_play(1, queued=0, new_stream=False, streams=0)
+    with pytest.raises(QuotaExceeded) as e:
+        quotas.admit_play(1, queued=0, new_stream=False, streams=0)
+    assert e.value.reason == "rate"
+    assert "1s" in str(e.value)
+    quotas.admit_play(2, queued=0, new_stream=False, streams=0)
+    with pytest.raises(QuotaExceeded) as e:
+        quotas.admit_play(3, queued=0, new_stream=False, streams=0)
+    assert e.value.reason == "global_rate"
+
+def test_zero_limits_admit_everything():
+    quotas = Quotas()
+    for _ in range(100):
+        quotas.admit_play(1, queued=10000, new_stream=True, streams=10000)
+    assert quotas.queue_room(10000) is None
+    assert Quotas(max_queue=5).queue_room(3) == 2
@@ -0,0 +1,70 @@
+import discord
+
+from shared_audio import SharedStreams
+
+class FakeSource(discord.AudioSource):
+    """A fixed number of numbered frames"""
+    spawned = 0
+
+    def __init__(self, frames=50):
+        FakeSource.spawned += 1
+        self.frames = iter([f"frame {i}".encode() for i in range(frames)])
+        self.cleaned = False
+
+    def read(self):
+        return next(self.frames, b'')
+
+    def cleanup(self):
+        self.cleaned = True
+
+def fallback(offset):
+    return FakeSource()
+
+def setup_function():
+    FakeSource.spawned = 0
+
+def test_prepared_source_holds_no_place_until_it_plays():
+    streams = SharedStreams(buffer_seconds=60)
+    warmed = streams.consume("song", FakeSource, fallback)
+    assert streams.consumers() == 0 and not streams.streams
+    assert FakeSource.spawned == 1  # Decoder started early, like an unshared warm source
+
+    assert warmed.read() == b"frame 0"
+    assert streams.consumers() == 1
+    assert FakeSource.spawned == 1
+    warmed.cleanup()
+
+def test_dropped_prepared_source_never_joins():
+    streams = SharedStreams(buffer_seconds=60)
+    playing = streams.consume("song", FakeSource, fallback)
+    playing.read()
+    warmed = streams.consume("song", FakeSource, fallback)
+    assert warmed.spare is None  # Could join the playing stream, so nothing was spawned
+    warmed.cleanup()
+    assert streams.consumers() == 1
+    assert warmed.read() == b''
+    playing.cleanup()
+
+def test_late_starter_joins_and_drops_its_spare():
+    streams = SharedStreams(buffer_seconds=60)
+    first = streams.consume("song", FakeSource, fallback)
+    second = streams.consume("song", FakeSource, fallback)
+    assert FakeSource.spawned == 2  # Neither had a stream to join when prepared
+    spare = second.spare
+    assert first.read() == b"frame 0"
+    assert second.read() == b"frame 0"
+    assert second.stream is first.stream
+    assert streams.stats == {'shared': 1, 'opened': 1}
+    assert spare.cleaned and second.spare is None
+    first.cleanup()
+    second.cleanup()
+
+def test_keys_keep_streams_apart():
+    streams = SharedStreams(buffer_seconds=60)
+    high = streams.consume(("song", "opus", "high"), FakeSource, fallback)
+    economy = streams.consume(("song", "opus", "economy"), FakeSource, fallback)
+    high.read()
+    economy.read()
+    assert high.stream is not economy.stream
+    high.cleanup()
+    economy.cleanup()